@@ -53,6 +53,7 @@ def plot_lyapunov_1d(lyapunov, true_dynamics, legend=False):
 
     extent = [np.min(states), np.max(states)]
     safe_set = lyapunov.safe_set
+    values = lyapunov.get_values()
     threshold = lyapunov.threshold(states)
 
     # Create figure axes
@@ -107,8 +108,8 @@ def plot_lyapunov_1d(lyapunov, true_dynamics, legend=False):
     ax2.set_xlim(extent)
 
     # # Plot Lyapunov function
-    V_unsafe = np.ma.masked_where(safe_set, lyapunov.values)
-    V_safe = np.ma.masked_where(~safe_set, lyapunov.values)
+    V_unsafe = np.ma.masked_where(safe_set, values)
+    V_safe = np.ma.masked_where(~safe_set, values)
     unsafe_plot = ax2.plot(states, V_unsafe,
                            color='b',
                            label=r'$V(x)$ (unsafe, $\Delta V(x) > L \tau$)')
@@ -123,7 +124,7 @@ def plot_lyapunov_1d(lyapunov, true_dynamics, legend=False):
 
     # Create helper lines
     if np.any(safe_set):
-        max_id = np.argmax(lyapunov.values[safe_set])
+        max_id = np.argmax(values[safe_set])
         x_safe = states[safe_set][max_id]
         y_range = axes[1].get_ylim()
         axes[1].plot([x_safe, x_safe], y_range, 'k-.')
@@ -54,6 +54,8 @@ multiplied, and stacked as needed.
    NeuralNetwork
    GaussianProcess
    GPRCached
+   SGPRCached
+   KroneckerGPR
    sample_gp_function
 
 
@@ -82,6 +84,7 @@ These are utilities to make working with tensorflow more pleasant.
    utilities.set_storage
    utilities.unique_rows
    utilities.gradient_clipping
+   utilities.parameter_token
 
 """
 
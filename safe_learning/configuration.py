@@ -18,6 +18,13 @@ class Configuration(object):
         # Batch size for stability verification
         self.gp_batch_size = 10000
 
+        # Number of batches that are verified concurrently
+        self.num_workers = 1
+
+        # Influence of new data on the prediction (relative to the residuals)
+        # above which states are verified again
+        self.correlation_tolerance = 1e-3
+
     @property
     def np_dtype(self):
         """Return the numpy dtype."""
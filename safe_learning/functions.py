@@ -2,8 +2,11 @@
 
 from __future__ import absolute_import, print_function, division
 
+import hashlib
+from collections import OrderedDict
 from types import ModuleType
-from itertools import product as cartesian
+from itertools import product as cartesian, permutations
+from math import factorial
 from functools import partial
 
 from future.builtins import zip, range
@@ -16,14 +19,14 @@ except ImportError as exception:
     gpflow = exception
 
 from .utilities import (concatenate_inputs, make_tf_fun, with_scope,
-                        use_parent_scope, get_feed_dict)
+                        use_parent_scope, get_feed_dict, batchify)
 from safe_learning import config
 
 __all__ = ['DeterministicFunction', '_Triangulation', 'Triangulation',
            'PiecewiseConstant', 'GridWorld', 'UncertainFunction',
            'FunctionStack', 'QuadraticFunction', 'GaussianProcess',
-           'GPRCached', 'sample_gp_function', 'LinearSystem', 'Saturation',
-           'NeuralNetwork']
+           'GPRCached', 'SGPRCached', 'KroneckerGPR', 'sample_gp_function',
+           'LinearSystem', 'Saturation', 'NeuralNetwork']
 
 _EPS = np.finfo(config.np_dtype).eps
 
@@ -50,6 +53,9 @@ class Function(object):
                                           self.build_evaluation,
                                           create_scope_now_=True)
 
+        # Placeholders and outputs for the evaluation of numpy arrays
+        self._evaluators = {}
+
     @property
     def scope_name(self):
         return self._scope.original_name_scope
@@ -80,6 +86,40 @@ class Function(object):
             outputs = self._template(*args, **kwargs)
         return outputs
 
+    def evaluate(self, *args):
+        """Evaluate the function on numpy arrays.
+
+        The evaluation graph is built once for each combination of input
+        dimensions and dtypes and fed with placeholders afterwards, so that
+        repeated calls do not add new operations to the graph.
+
+        Parameters
+        ----------
+        args : list of ndarray
+            The input arguments to the function, each with the batch
+            dimension first.
+
+        Returns
+        -------
+        outputs : ndarray or list of ndarray
+            The evaluated outputs of the function.
+        """
+        args = [np.asarray(arg) for arg in args]
+        key = tuple((arg.shape[1:], arg.dtype) for arg in args)
+
+        if key not in self._evaluators:
+            placeholders = [tf.placeholder(arg.dtype,
+                                           shape=(None,) + arg.shape[1:],
+                                           name='evaluate_input')
+                            for arg in args]
+            self._evaluators[key] = (placeholders, self(*placeholders))
+
+        placeholders, outputs = self._evaluators[key]
+
+        feed_dict = self.feed_dict.copy()
+        feed_dict.update(zip(placeholders, args))
+        return tf.get_default_session().run(outputs, feed_dict=feed_dict)
+
     def build_evaluation(self, *args, **kwargs):
         """Build the function evaluation tree.
 
@@ -246,6 +286,20 @@ class ConstantFunction(DeterministicFunction):
         return self.constant
 
 
+def _equal_parameters(first, second):
+    """Check whether two gpflow objects have the same parameter values."""
+    if type(first) is not type(second):
+        return False
+    if isinstance(first, gpflow.param.Param):
+        return np.array_equal(first.value, second.value)
+
+    children = first.sorted_params
+    other_children = second.sorted_params
+    return (len(children) == len(other_children)
+            and all(_equal_parameters(child, other_child)
+                    for child, other_child in zip(children, other_children)))
+
+
 class FunctionStack(UncertainFunction):
     """A combination of multiple 1d (uncertain) functions for each dim.
 
@@ -253,9 +307,16 @@ class FunctionStack(UncertainFunction):
     ----------
     functions : list
         The functions. There should be one for each dimension of the output.
+    shared_kernel : bool, optional
+        Whether the functions are instances of `GaussianProcess` with
+        `GPRCached` models that share the same data inputs, kernel and
+        likelihood, and only differ in their measurements. In this case, the
+        kernel matrix and the cholesky decomposition are computed only once
+        for all outputs.
     """
 
-    def __init__(self, functions, name='function_stack'):
+    def __init__(self, functions, name='function_stack',
+                 shared_kernel=False):
         """Initialization, see `FunctionStack`."""
         super(FunctionStack, self).__init__(name=name)
         self.functions = functions
@@ -264,6 +325,28 @@ class FunctionStack(UncertainFunction):
         self.input_dim = self.functions[0].input_dim
         self.output_dim = sum(fun.output_dim for fun in self.functions)
 
+        self.shared_kernel = shared_kernel
+        if shared_kernel:
+            self._check_shared_kernel()
+
+    def _check_shared_kernel(self):
+        """Make sure that all GPs can share the kernel computations."""
+        first = self.functions[0]
+        for fun in self.functions:
+            if not (isinstance(fun, GaussianProcess)
+                    and type(fun.gaussian_process) is GPRCached):
+                raise ValueError('A shared kernel requires GPRCached models.')
+            if not np.array_equal(fun.X, first.X):
+                raise ValueError('A shared kernel requires the same data '
+                                 'inputs for all models.')
+
+            gp, first_gp = fun.gaussian_process, first.gaussian_process
+            if not (_equal_parameters(gp.kern, first_gp.kern)
+                    and _equal_parameters(gp.likelihood,
+                                          first_gp.likelihood)):
+                raise ValueError('A shared kernel requires the same kernel '
+                                 'and likelihood parameters for all models.')
+
     @property
     def parameters(self):
         """Return the parameters."""
@@ -272,6 +355,9 @@ class FunctionStack(UncertainFunction):
     @concatenate_inputs(start=1)
     def build_evaluation(self, points):
         """Evaluation, see `UncertainFunction.evaluate`."""
+        if self.shared_kernel:
+            return self._build_shared_evaluation(points)
+
         means = []
         errors = []
         for fun in self.functions:
@@ -284,6 +370,56 @@ class FunctionStack(UncertainFunction):
 
         return mean, error
 
+    def _build_shared_evaluation(self, points):
+        """Evaluate all GPs with one kernel evaluation and solve."""
+        alphas = []
+        prior_means = []
+        for fun in self.functions:
+            gp = fun.gaussian_process
+            with gp.tf_mode():
+                alphas.append(gp.alpha)
+                prior_means.append(gp.mean_function(points))
+
+        gp = self.functions[0].gaussian_process
+        with gp.tf_mode():
+            kx = gp.kern.K(gp.X, points)
+            a = tf.matrix_triangular_solve(gp.cholesky, kx, lower=True)
+            var = gp.kern.Kdiag(points) - tf.reduce_sum(tf.square(a), 0)
+
+        mean = tf.matmul(a, tf.concat(alphas, axis=1), transpose_a=True)
+        mean = tf.add(mean, tf.concat(prior_means, axis=1),
+                      name='stacked_mean')
+
+        # All outputs have the same variance, but may be scaled differently
+        betas = np.concatenate([np.full(fun.output_dim, fun.beta)
+                                for fun in self.functions])
+        std = tf.sqrt(var, name='standard_deviation')
+        error = tf.multiply(std[:, None], betas, name='stacked_error')
+        return mean, error
+
+    @use_parent_scope
+    @with_scope('correlation')
+    def correlation(self, points, data):
+        """Return the largest influence of the data on the posterior.
+
+        Parameters
+        ----------
+        points : ndarray or tf.Tensor
+            A 2D array with one input point on each row.
+        data : ndarray or tf.Tensor
+            A 2D array with one data point on each row.
+
+        Returns
+        -------
+        correlation : tf.Tensor
+            A 1D tensor with the largest influence of any of the data points
+            on the posterior at each point, maximized over all functions. See
+            `GaussianProcess.correlation`.
+        """
+        correlations = [fun.correlation(points, data)
+                        for fun in self.functions]
+        return tf.reduce_max(tf.stack(correlations, axis=1), axis=1)
+
     def add_data_point(self, x, y):
         """Add data points to the GP model and update cholesky.
 
@@ -296,8 +432,34 @@ class FunctionStack(UncertainFunction):
             A 2d array with the new measurements to add to the GP model.
             Each measurements is on a new row.
         """
-        for fun, yi in zip(self.functions, y.squeeze()):
-            fun.add_data_point(x, yi)
+        x = np.atleast_2d(x)
+        y = np.atleast_2d(y)
+
+        # Split the measurements according to the function outputs
+        output_dims = [fun.output_dim for fun in self.functions]
+        ys = np.split(y, np.cumsum(output_dims)[:-1], axis=1)
+
+        if not self.shared_kernel:
+            for fun, yi in zip(self.functions, ys):
+                fun.add_data_point(x, yi)
+            return
+
+        # Hyperparameters may have changed since the last update
+        self._check_shared_kernel()
+
+        gps = [fun.gaussian_process for fun in self.functions]
+        for gp, yi in zip(gps, ys):
+            gp.X = np.vstack((gp.X.value, x))
+            gp.Y = np.vstack((gp.Y.value, yi))
+
+        # Update the cholesky decomposition once and reuse it
+        gps[0].update_cache()
+        for gp in gps[1:]:
+            gp.set_cache(gps[0].cholesky.value,
+                         num_updates=gps[0].num_updates)
+
+        for fun in self.functions:
+            fun.update_feed_dict()
 
 
 class Saturation(DeterministicFunction):
@@ -355,11 +517,16 @@ class GPRCached(gpflow.gpr.GPR):
     y : ndarray
         A 2d array with measurements to initialize the GP model. Each
         measurement is on a row.
+    refactorization_interval : int, optional
+        When data points are added, the cholesky decomposition is extended
+        by the new rows in O(n^2). Every refactorization_interval updates it
+        is recomputed from scratch in O(n^3) instead, which bounds the
+        accumulation of numerical errors. Set to 1 to always recompute it.
 
     """
 
     def __init__(self, x, y, kern, mean_function=gpflow.mean_functions.Zero(),
-                 name='GPRCached'):
+                 name='GPRCached', refactorization_interval=100):
         """Initialize GP and cholesky decomposition."""
         # Make sure gpflow is imported
         if not isinstance(gpflow, ModuleType):
@@ -374,7 +541,11 @@ class GPRCached(gpflow.gpr.GPR):
                                                 on_shape_change='pass')
         self.alpha = gpflow.param.DataHolder(np.empty((0, 0), dtype=dtype),
                                              on_shape_change='pass')
-        self.update_cache()
+
+        self.refactorization_interval = refactorization_interval
+        self._num_updates = 0
+        self._cache_state = None
+        self.update_cache(full=True)
 
     @with_scope('compute_cache')
     @gpflow.param.AutoFlow()
@@ -389,9 +560,104 @@ class GPRCached(gpflow.gpr.GPR):
         alpha = tf.matrix_triangular_solve(cholesky, target, name='gp_alpha')
         return cholesky, alpha
 
-    def update_cache(self):
-        """Update the cache after adding data points."""
-        self.cholesky, self.alpha = self._compute_cache()
+    @with_scope('extend_cache')
+    @gpflow.param.AutoFlow()
+    def _extend_cache(self):
+        """Extend the cache by the data points that were added last."""
+        num_old = tf.shape(self.cholesky)[0]
+        x_old, x_new = self.X[:num_old], self.X[num_old:]
+        num_new = tf.shape(x_new)[0]
+
+        # New off-diagonal block of the cholesky decomposition
+        kernel_cross = self.kern.K(x_old, x_new)
+        cross = tf.matrix_triangular_solve(self.cholesky, kernel_cross,
+                                           lower=True)
+
+        # New diagonal block from the Schur complement
+        identity = tf.eye(num_new, dtype=config.dtype)
+        kernel_new = self.kern.K(x_new) + identity * self.likelihood.variance
+        schur = kernel_new - tf.matmul(cross, cross, transpose_a=True)
+        cholesky_new = tf.cholesky(schur, name='gp_cholesky')
+
+        target = self.Y[num_old:] - self.mean_function(x_new)
+        target -= tf.matmul(cross, self.alpha, transpose_a=True)
+        alpha_new = tf.matrix_triangular_solve(cholesky_new, target,
+                                               name='gp_alpha')
+
+        zeros = tf.zeros(tf.stack((num_old, num_new)), dtype=config.dtype)
+        cholesky = tf.concat((tf.concat((self.cholesky, zeros), axis=1),
+                              tf.concat((tf.transpose(cross), cholesky_new),
+                                        axis=1)),
+                             axis=0)
+        alpha = tf.concat((self.alpha, alpha_new), axis=0)
+        return cholesky, alpha
+
+    @with_scope('compute_alpha')
+    @gpflow.param.AutoFlow()
+    def _compute_alpha(self):
+        """Compute alpha for the cached cholesky decomposition."""
+        target = self.Y - self.mean_function(self.X)
+        return tf.matrix_triangular_solve(self.cholesky, target,
+                                          name='gp_alpha')
+
+    def update_cache(self, full=False):
+        """Update the cache after adding data points.
+
+        Parameters
+        ----------
+        full : bool, optional
+            Whether to recompute the cholesky decomposition from scratch. By
+            default, the decomposition is only extended by new data points,
+            unless the hyperparameters changed or it is due according to
+            `refactorization_interval`. Existing data points must not have
+            been modified in this case.
+        """
+        num_cached = self.cholesky.value.shape[0]
+        num_data = self.X.value.shape[0]
+        state = self.get_free_state()
+
+        full = (full
+                or not 0 < num_cached <= num_data
+                or not np.array_equal(state, self._cache_state))
+
+        # Only extensions of the decomposition accumulate numerical errors
+        if not full and num_cached < num_data:
+            self._num_updates += 1
+            full = self._num_updates >= self.refactorization_interval
+
+        if full:
+            self.cholesky, self.alpha = self._compute_cache()
+            self._num_updates = 0
+            self._cache_state = state.copy()
+        elif num_cached < num_data:
+            self.cholesky, self.alpha = self._extend_cache()
+
+    @property
+    def num_updates(self):
+        """Number of cache extensions since the last refactorization."""
+        return self._num_updates
+
+    def set_cache(self, cholesky, alpha=None, num_updates=0):
+        """Set the cache to a cholesky decomposition computed elsewhere.
+
+        Parameters
+        ----------
+        cholesky : ndarray
+            The cholesky decomposition of the kernel matrix of the current
+            data and hyperparameters.
+        alpha : ndarray, optional
+            The solution of the triangular system with the measurements. Is
+            computed from the cholesky decomposition if not provided.
+        num_updates : int, optional
+            The number of extensions of the decomposition since it was last
+            recomputed from scratch.
+        """
+        self.cholesky = cholesky
+        if alpha is None:
+            alpha = self._compute_alpha()
+        self.alpha = alpha
+        self._num_updates = num_updates
+        self._cache_state = self.get_free_state().copy()
 
     @with_scope('build_predict')
     def build_predict(self, Xnew, full_cov=False):
@@ -427,6 +693,607 @@ class GPRCached(gpflow.gpr.GPR):
                            [1, tf.shape(self.Y)[1]])
         return fmean, fvar
 
+    @with_scope('build_covariance')
+    def build_covariance(self, X1, X2):
+        """Return the posterior covariance between two sets of points.
+
+        Parameters
+        ----------
+        X1 : ndarray
+            The first set of points, one on each row.
+        X2 : ndarray
+            The second set of points, one on each row.
+
+        Returns
+        -------
+        covariance : tf.Tensor
+            The posterior covariance matrix between X1 and X2.
+        """
+        a1 = tf.matrix_triangular_solve(self.cholesky, self.kern.K(self.X, X1),
+                                        lower=True)
+        a2 = tf.matrix_triangular_solve(self.cholesky, self.kern.K(self.X, X2),
+                                        lower=True)
+        return self.kern.K(X1, X2) - tf.matmul(a1, a2, transpose_a=True)
+
+
+class SGPRCached(gpflow.sgpr.SGPR):
+    """gpflow.sgpr.SGPR class that caches the inducing-point posterior.
+
+    The predictions of the sparse GP only depend on the data through
+    statistics of the kernel between data and inducing points. These are
+    cached and extended when data points are added, so that neither
+    predictions nor updates scale with the number of data points.
+
+    Parameters
+    ----------
+    x : ndarray
+        A 2d array with states to initialize the GP model. Each state is on
+        a row.
+    y : ndarray
+        A 2d array with measurements to initialize the GP model. Each
+        measurement is on a row.
+    kern : instance of gpflow.kernels.Kern
+        The kernel of the GP.
+    z : ndarray
+        A 2d array with the inducing inputs. Their number M is the budget of
+        the approximation: predictions cost O(M^2) per point and adding k
+        data points costs O(k M^2 + M^3), independent of the number of data
+        points. The inducing inputs are parameters of the model and can be
+        optimized together with the hyperparameters.
+
+    """
+
+    def __init__(self, x, y, kern, z,
+                 mean_function=gpflow.mean_functions.Zero()):
+        """Initialize GP and the cached posterior."""
+        # Make sure gpflow is imported
+        if not isinstance(gpflow, ModuleType):
+            raise gpflow
+
+        gpflow.sgpr.SGPR.__init__(self, x, y, kern, z, mean_function)
+
+        # Create new dataholders for the cached data
+        dtype = config.np_dtype
+        empty = np.empty((0, 0), dtype=dtype)
+        self.cholesky = gpflow.param.DataHolder(empty,
+                                                on_shape_change='pass')
+        self.cholesky_b = gpflow.param.DataHolder(empty,
+                                                  on_shape_change='pass')
+        self.alpha = gpflow.param.DataHolder(empty, on_shape_change='pass')
+
+        # Statistics of the data that the cache is based on
+        self._kuf_kfu = None
+        self._kuf_y = None
+        self._num_cached = 0
+        self._cache_state = None
+        self.update_cache(full=True)
+
+    @property
+    def num_inducing(self):
+        """Return the number of inducing points."""
+        return self.Z.value.shape[0]
+
+    @with_scope('data_statistics')
+    @gpflow.param.AutoFlow((config.dtype, [None, None]),
+                           (config.dtype, [None, None]))
+    def _data_statistics(self, x, y):
+        """Return the kernel statistics of the data points."""
+        kuf = self.kern.K(self.Z, x)
+        target = y - self.mean_function(x)
+        return (tf.matmul(kuf, kuf, transpose_b=True),
+                tf.matmul(kuf, target))
+
+    @with_scope('compute_cache')
+    @gpflow.param.AutoFlow((config.dtype, [None, None]),
+                           (config.dtype, [None, None]))
+    def _compute_cache(self, kuf_kfu, kuf_y):
+        """Compute the cache from the data statistics."""
+        num_inducing = tf.shape(self.Z)[0]
+        identity = tf.eye(num_inducing, dtype=config.dtype)
+        jitter = gpflow.settings.numerics.jitter_level
+
+        kuu = self.kern.K(self.Z) + identity * jitter
+        cholesky = tf.cholesky(kuu, name='gp_cholesky')
+
+        # B = I + L^-1 Kuf Kfu L^-T / noise
+        variance = self.likelihood.variance
+        tmp = tf.matrix_triangular_solve(cholesky, kuf_kfu)
+        tmp = tf.matrix_triangular_solve(cholesky, tf.transpose(tmp))
+        cholesky_b = tf.cholesky(identity + tmp / variance,
+                                 name='gp_cholesky_b')
+
+        alpha = tf.matrix_triangular_solve(cholesky, kuf_y)
+        alpha = tf.matrix_triangular_solve(cholesky_b, alpha) / variance
+        return cholesky, cholesky_b, alpha
+
+    def update_cache(self, full=False):
+        """Update the cache after adding data points.
+
+        Parameters
+        ----------
+        full : bool, optional
+            Whether to recompute the data statistics from all data points.
+            By default, only the statistics of new data points are added,
+            unless the parameters of the model changed. Existing data points
+            must not have been modified in this case.
+        """
+        x = self.X.value
+        y = self.Y.value
+        state = self.get_free_state()
+
+        full = (full
+                or not self._num_cached <= len(x)
+                or not np.array_equal(state, self._cache_state))
+
+        if full:
+            self._kuf_kfu, self._kuf_y = self._data_statistics(x, y)
+            self._cache_state = state.copy()
+        elif self._num_cached < len(x):
+            new = slice(self._num_cached, None)
+            kuf_kfu, kuf_y = self._data_statistics(x[new], y[new])
+            self._kuf_kfu += kuf_kfu
+            self._kuf_y += kuf_y
+        else:
+            return
+
+        self._num_cached = len(x)
+        self.cholesky, self.cholesky_b, self.alpha = self._compute_cache(
+            self._kuf_kfu, self._kuf_y)
+
+    @with_scope('build_predict')
+    def build_predict(self, Xnew, full_cov=False):
+        """Predict mean and variance of the GP at locations in Xnew.
+
+        Parameters
+        ----------
+        Xnew : ndarray
+            The points at which to evaluate the function. One row for each
+            data points.
+        full_cov : bool
+            if False returns only the diagonal of the covariance matrix
+
+        Returns
+        -------
+        mean : ndarray
+            The expected function values at the points.
+        error_bounds : ndarray
+            Diagonal of the covariance matrix (or full matrix).
+
+        """
+        Kus = self.kern.K(self.Z, Xnew)
+        tmp1 = tf.matrix_triangular_solve(self.cholesky, Kus, lower=True)
+        tmp2 = tf.matrix_triangular_solve(self.cholesky_b, tmp1, lower=True)
+        fmean = (tf.matmul(tmp2, self.alpha, transpose_a=True)
+                 + self.mean_function(Xnew))
+        if full_cov:
+            fvar = (self.kern.K(Xnew)
+                    + tf.matmul(tmp2, tmp2, transpose_a=True)
+                    - tf.matmul(tmp1, tmp1, transpose_a=True))
+            shape = tf.stack([1, 1, tf.shape(self.Y)[1]])
+            fvar = tf.tile(tf.expand_dims(fvar, 2), shape)
+        else:
+            fvar = (self.kern.Kdiag(Xnew)
+                    + tf.reduce_sum(tf.square(tmp2), 0)
+                    - tf.reduce_sum(tf.square(tmp1), 0))
+            fvar = tf.tile(tf.reshape(fvar, (-1, 1)),
+                           [1, tf.shape(self.Y)[1]])
+        return fmean, fvar
+
+    @with_scope('build_covariance')
+    def build_covariance(self, X1, X2):
+        """Return the posterior covariance between two sets of points.
+
+        Parameters
+        ----------
+        X1 : ndarray
+            The first set of points, one on each row.
+        X2 : ndarray
+            The second set of points, one on each row.
+
+        Returns
+        -------
+        covariance : tf.Tensor
+            The posterior covariance matrix between X1 and X2.
+        """
+        tmp1 = [tf.matrix_triangular_solve(self.cholesky,
+                                           self.kern.K(self.Z, x),
+                                           lower=True)
+                for x in (X1, X2)]
+        tmp2 = [tf.matrix_triangular_solve(self.cholesky_b, tmp, lower=True)
+                for tmp in tmp1]
+        return (self.kern.K(X1, X2)
+                + tf.matmul(tmp2[0], tmp2[1], transpose_a=True)
+                - tf.matmul(tmp1[0], tmp1[1], transpose_a=True))
+
+
+def _kronecker_rows(matrices):
+    """Return the row-wise Kronecker product of matrices.
+
+    Parameters
+    ----------
+    matrices : list of tf.Tensor
+        Matrices with the same number of rows.
+
+    Returns
+    -------
+    product : tf.Tensor
+        A matrix whose i-th row is the Kronecker product of the i-th rows of
+        the matrices.
+    """
+    product = matrices[0]
+    for matrix in matrices[1:]:
+        product = product[:, :, None] * matrix[:, None, :]
+        product = tf.reshape(product, tf.stack((tf.shape(product)[0], -1)))
+    return product
+
+
+def _kronecker_matmul(matrices, x):
+    """Multiply the Kronecker product of square matrices with x.
+
+    Parameters
+    ----------
+    matrices : list of tf.Tensor
+        The factors of the Kronecker product.
+    x : tf.Tensor
+        A 2d tensor with as many rows as the Kronecker product.
+
+    Returns
+    -------
+    product : tf.Tensor
+        The product, computed without forming the Kronecker product.
+    """
+    num_columns = tf.shape(x)[1]
+
+    # Apply the factors along the last axis and cycle it to the front
+    product = tf.transpose(x)
+    for matrix in reversed(matrices):
+        size = tf.shape(matrix)[0]
+        product = tf.matmul(tf.reshape(product, tf.stack((-1, size))),
+                            matrix, transpose_b=True)
+        product = tf.reshape(tf.transpose(product), tf.stack((size, -1)))
+    return tf.reshape(product, tf.stack((-1, num_columns)))
+
+
+class KroneckerGPR(GPRCached):
+    """gpflow.gpr.GPR class for data inputs on a grid.
+
+    If the data inputs are the Cartesian product of points along each
+    dimension and the kernel factorizes over the input dimensions, the kernel
+    matrix is the Kronecker product of one small kernel matrix per
+    dimension. Inference then only requires the eigendecompositions of these
+    factors, which reduces the cost from O(N^3) to O(d N^(1 + 1/d)).
+
+    If the data inputs do not form a grid, for example after a single data
+    point was added with `GaussianProcess.add_data_point`, the model falls
+    back to the dense inference of `GPRCached`.
+
+    Parameters
+    ----------
+    x : ndarray
+        A 2d array with states to initialize the GP model. Each state is on
+        a row. The states can be in any order.
+    y : ndarray
+        A 2d array with measurements to initialize the GP model. Each
+        measurement is on a row.
+    kern : instance of gpflow.kernels.Kern
+        The kernel of the GP. It must factorize over the input dimensions,
+        that is, be a `gpflow.kernels.RBF` kernel or a product of them.
+    refactorization_interval : int, optional
+        See `GPRCached`. Only used for data inputs that are not on a grid.
+
+    """
+
+    def __init__(self, x, y, kern, mean_function=gpflow.mean_functions.Zero(),
+                 name='KroneckerGPR', refactorization_interval=100):
+        """Initialize GP and the eigendecomposition."""
+        # Make sure gpflow is imported
+        if not isinstance(gpflow, ModuleType):
+            raise gpflow
+
+        if not self._is_separable(kern):
+            raise ValueError('The kernel must be a gpflow.kernels.RBF kernel '
+                             'or a product of them.')
+
+        gpflow.gpr.GPR.__init__(self, x, y, kern, mean_function, name)
+        self.input_dim = x.shape[1]
+
+        # Create new dataholders for the grid and the cached data
+        dtype = config.np_dtype
+        empty = np.empty((0, 0), dtype=dtype)
+        self.cholesky = gpflow.param.DataHolder(empty, on_shape_change='pass')
+        self.use_dense = gpflow.param.DataHolder(np.array(0, dtype=np.int32),
+                                                 on_shape_change='pass')
+        for i in range(self.input_dim):
+            setattr(self, 'grid_{}'.format(i),
+                    gpflow.param.DataHolder(empty, on_shape_change='pass'))
+            setattr(self, 'eigenvectors_{}'.format(i),
+                    gpflow.param.DataHolder(empty, on_shape_change='pass'))
+        self.permutation = gpflow.param.DataHolder(np.empty(0, dtype=np.int32),
+                                                   on_shape_change='pass')
+        self.eigenvalues = gpflow.param.DataHolder(np.empty(0, dtype=dtype),
+                                                   on_shape_change='pass')
+        self.alpha = gpflow.param.DataHolder(empty, on_shape_change='pass')
+
+        self.refactorization_interval = refactorization_interval
+        self._num_updates = 0
+        self._num_cached = 0
+        self._cache_state = None
+        self.update_cache(full=True)
+
+    @property
+    def grid(self):
+        """Return the grid points along each dimension."""
+        return [getattr(self, 'grid_{}'.format(i))
+                for i in range(self.input_dim)]
+
+    @property
+    def eigenvectors(self):
+        """Return the eigenvectors of the kernel factors."""
+        return [getattr(self, 'eigenvectors_{}'.format(i))
+                for i in range(self.input_dim)]
+
+    @staticmethod
+    def _is_separable(kern):
+        """Check whether the kernel is a product over the input dimensions."""
+        if isinstance(kern, gpflow.kernels.Prod):
+            return all(KroneckerGPR._is_separable(kernel)
+                       for kernel in kern.kern_list)
+        return isinstance(kern, gpflow.kernels.RBF)
+
+    @staticmethod
+    def _grid_structure(x):
+        """Return the grid that the states lie on.
+
+        Parameters
+        ----------
+        x : ndarray
+            A 2d array with states.
+
+        Returns
+        -------
+        grid : list of ndarray
+            The sorted points along each dimension, as column vectors.
+        permutation : ndarray
+            The permutation that sorts the states in C order of the grid.
+        """
+        grid, indices = zip(*[np.unique(column, return_inverse=True)
+                              for column in x.T])
+        num_points = [len(points) for points in grid]
+        flat_indices = np.ravel_multi_index(indices, num_points)
+
+        if (np.prod(num_points) != len(x)
+                or np.any(np.bincount(flat_indices) != 1)):
+            raise ValueError('The states do not form a grid.')
+
+        grid = [points[:, None] for points in grid]
+        return grid, np.argsort(flat_indices).astype(np.int32)
+
+    def _kernel_factors(self, x, grid):
+        """Return the factors of the kernel matrix between x and the grid."""
+        # Evaluate the kernel along one dimension with all others at zero
+        origin = tf.zeros((1, self.input_dim), dtype=config.dtype)
+        scaling = self.kern.Kdiag(origin)[0]
+
+        factors = []
+        for i, (x_i, grid_i) in enumerate(zip(x, grid)):
+            mask = np.eye(self.input_dim)[i]
+            factor = self.kern.K(x_i * mask, grid_i * mask)
+            factors.append(factor if i == 0 else factor / scaling)
+        return factors
+
+    def _build_eigendecomposition(self):
+        """Return the eigendecomposition and the targets in grid order."""
+        grid = self.grid
+        factors = self._kernel_factors(grid, grid)
+        eigenvalues, eigenvectors = zip(*[tf.self_adjoint_eig(factor)
+                                          for factor in factors])
+
+        eigenvalues = _kronecker_rows([tf.maximum(eigenvalue, 0)[None, :]
+                                       for eigenvalue in eigenvalues])
+        eigenvalues = tf.reshape(eigenvalues, [-1])
+
+        x = tf.gather(self.X, self.permutation)
+        target = tf.gather(self.Y, self.permutation) - self.mean_function(x)
+        return list(eigenvectors), eigenvalues, target
+
+    @with_scope('compute_kronecker_cache')
+    @gpflow.param.AutoFlow()
+    def _compute_kronecker_cache(self):
+        """Compute the cache for data inputs on a grid."""
+        eigenvectors, eigenvalues, target = self._build_eigendecomposition()
+        eigenvalues += self.likelihood.variance
+
+        transposed = [tf.transpose(vectors) for vectors in eigenvectors]
+        alpha = (_kronecker_matmul(transposed, target)
+                 / eigenvalues[:, None])
+        return eigenvectors + [eigenvalues, alpha]
+
+    def update_cache(self, full=False):
+        """Update the cache after adding data points.
+
+        Parameters
+        ----------
+        full : bool, optional
+            Whether to recompute the cache even if neither the number of
+            data points nor the parameters of the model changed.
+        """
+        x = self.X.value
+        state = self.get_free_state()
+
+        if (not full and self._num_cached == len(x)
+                and np.array_equal(state, self._cache_state)):
+            return
+
+        try:
+            grid, permutation = self._grid_structure(x)
+        except ValueError:
+            # Dense inference for data inputs that are not on a grid
+            if not self.use_dense.value:
+                self.use_dense = np.array(1, dtype=np.int32)
+                self.cholesky = np.empty((0, 0), dtype=config.np_dtype)
+            GPRCached.update_cache(self, full=full)
+            self._num_cached = len(x)
+            return
+
+        self.use_dense = np.array(0, dtype=np.int32)
+        self.cholesky = np.empty((0, 0), dtype=config.np_dtype)
+
+        self.permutation = permutation
+        for i, points in enumerate(grid):
+            setattr(self, 'grid_{}'.format(i), points)
+
+        cache = self._compute_kronecker_cache()
+        for i, vectors in enumerate(cache[:self.input_dim]):
+            setattr(self, 'eigenvectors_{}'.format(i), vectors)
+        self.eigenvalues, self.alpha = cache[self.input_dim:]
+
+        self._num_updates = 0
+        self._num_cached = len(x)
+        self._cache_state = state.copy()
+
+    @with_scope('build_likelihood')
+    def build_likelihood(self):
+        """Return the log marginal likelihood of the data."""
+        return tf.cond(tf.equal(self.use_dense, 1),
+                       lambda: gpflow.gpr.GPR.build_likelihood(self),
+                       self._build_kronecker_likelihood)
+
+    def _build_kronecker_likelihood(self):
+        """Return the log marginal likelihood for data inputs on a grid."""
+        eigenvectors, eigenvalues, target = self._build_eigendecomposition()
+        eigenvalues += self.likelihood.variance
+
+        transposed = [tf.transpose(vectors) for vectors in eigenvectors]
+        projected = _kronecker_matmul(transposed, target)
+
+        num_data = tf.cast(tf.size(target), config.dtype)
+        num_outputs = tf.cast(tf.shape(target)[1], config.dtype)
+        return -0.5 * (tf.reduce_sum(tf.square(projected)
+                                     / eigenvalues[:, None])
+                       + num_outputs * tf.reduce_sum(tf.log(eigenvalues))
+                       + num_data * np.log(2 * np.pi))
+
+    @with_scope('build_predict')
+    def build_predict(self, Xnew, full_cov=False):
+        """Predict mean and variance of the GP at locations in Xnew.
+
+        Parameters
+        ----------
+        Xnew : ndarray
+            The points at which to evaluate the function. One row for each
+            data points.
+        full_cov : bool
+            if False returns only the diagonal of the covariance matrix
+
+        Returns
+        -------
+        mean : ndarray
+            The expected function values at the points.
+        error_bounds : ndarray
+            Diagonal of the covariance matrix (or full matrix).
+
+        """
+        fmean, fvar = tf.cond(
+            tf.equal(self.use_dense, 1),
+            lambda: GPRCached.build_predict(self, Xnew, full_cov=full_cov),
+            lambda: self._build_kronecker_predict(Xnew, full_cov=full_cov))
+        return fmean, fvar
+
+    def _build_eigenbasis_kernel(self, Xnew):
+        """Return the kernel between Xnew and the grid in the eigenbasis."""
+        x = [Xnew[:, i:i + 1] for i in range(self.input_dim)]
+        factors = self._kernel_factors(x, self.grid)
+        return _kronecker_rows([tf.matmul(factor, vectors)
+                                for factor, vectors
+                                in zip(factors, self.eigenvectors)])
+
+    def _build_kronecker_predict(self, Xnew, full_cov=False):
+        """Predict mean and variance for data inputs on a grid."""
+        projected = self._build_eigenbasis_kernel(Xnew)
+
+        fmean = tf.matmul(projected, self.alpha) + self.mean_function(Xnew)
+        scaled = projected / tf.sqrt(self.eigenvalues)
+        if full_cov:
+            fvar = self.kern.K(Xnew) - tf.matmul(scaled, scaled,
+                                                 transpose_b=True)
+            shape = tf.stack([1, 1, tf.shape(self.Y)[1]])
+            fvar = tf.tile(tf.expand_dims(fvar, 2), shape)
+        else:
+            fvar = self.kern.Kdiag(Xnew) - tf.reduce_sum(tf.square(scaled), 1)
+            fvar = tf.tile(tf.reshape(fvar, (-1, 1)),
+                           [1, tf.shape(self.Y)[1]])
+        return fmean, fvar
+
+    @with_scope('build_covariance')
+    def build_covariance(self, X1, X2):
+        """Return the posterior covariance between two sets of points.
+
+        Parameters
+        ----------
+        X1 : ndarray
+            The first set of points, one on each row.
+        X2 : ndarray
+            The second set of points, one on each row.
+
+        Returns
+        -------
+        covariance : tf.Tensor
+            The posterior covariance matrix between X1 and X2.
+        """
+        return tf.cond(
+            tf.equal(self.use_dense, 1),
+            lambda: GPRCached.build_covariance(self, X1, X2),
+            lambda: self._build_kronecker_covariance(X1, X2))
+
+    def _build_kronecker_covariance(self, X1, X2):
+        """Return the posterior covariance for data inputs on a grid."""
+        scaling = tf.sqrt(self.eigenvalues)
+        scaled1 = self._build_eigenbasis_kernel(X1) / scaling
+        scaled2 = self._build_eigenbasis_kernel(X2) / scaling
+        return self.kern.K(X1, X2) - tf.matmul(scaled1, scaled2,
+                                               transpose_b=True)
+
+    @with_scope('sample_f')
+    @gpflow.param.AutoFlow((tf.int32, []))
+    def _sample_f(self, number):
+        """Sample from the posterior in the eigenbasis."""
+        variance = self.likelihood.variance
+        eigenvalues = self.eigenvalues[:, None]
+        kernel_eigenvalues = tf.maximum(eigenvalues - variance, 0)
+
+        shape = tf.stack((tf.shape(eigenvalues)[0], number))
+        prior = (tf.sqrt(kernel_eigenvalues)
+                 * tf.random_normal(shape, dtype=config.dtype))
+        noise = tf.sqrt(variance) * tf.random_normal(shape,
+                                                     dtype=config.dtype)
+
+        # Condition the prior samples on the data
+        residual = self.alpha[:, :1] * eigenvalues - prior - noise
+        sample = prior + kernel_eigenvalues / eigenvalues * residual
+        sample = _kronecker_matmul(self.eigenvectors, sample)
+
+        indices = tf.invert_permutation(self.permutation)
+        return tf.gather(sample, indices) + self.mean_function(self.X)
+
+    def sample_f(self, number=1):
+        """Sample function values at the data inputs from the posterior.
+
+        Parameters
+        ----------
+        number : int, optional
+            The number of samples.
+
+        Returns
+        -------
+        samples : ndarray
+            A (num_data x number) array with one sample in each column. Only
+            the first output of the GP is sampled.
+        """
+        self.update_cache()
+        if self.use_dense.value:
+            raise ValueError('Sampling requires data inputs on a grid.')
+        return self._sample_f(number)
+
 
 class GaussianProcess(UncertainFunction):
     """A GaussianProcess model based on gpflow.
@@ -483,6 +1350,48 @@ class GaussianProcess(UncertainFunction):
         std = self.beta * tf.sqrt(var, name='standard_deviation')
         return mean, std
 
+    @use_parent_scope
+    @with_scope('correlation')
+    def correlation(self, points, data):
+        """Return the largest influence of the data on the posterior.
+
+        Conditioning on data points with noise variance s changes the
+        posterior mean at a point by k(x, X) / s times the residuals of the
+        data, where k is the posterior covariance after the data was added.
+        The change in the posterior variance scales with the square of the
+        same quantity. It is independent of the prior scale and about one
+        at the data points themselves.
+
+        Parameters
+        ----------
+        points : ndarray or tf.Tensor
+            A 2D array with one input point on each row.
+        data : ndarray or tf.Tensor
+            A 2D array with one data point on each row, which are already
+            part of the model.
+
+        Returns
+        -------
+        correlation : tf.Tensor
+            A 1D tensor with the largest absolute posterior covariance
+            between each point and any of the data points, divided by the
+            noise variance.
+        """
+        gp = self.gaussian_process
+        with gp.tf_mode():
+            if hasattr(gp, 'build_covariance'):
+                covariance = gp.build_covariance(points, data)
+            else:
+                # Other models only provide the joint covariance matrix
+                num_points = tf.shape(points)[0]
+                joint = tf.concat((points, data), axis=0)
+                _, covariance = gp.build_predict(joint, full_cov=True)
+                covariance = covariance[:num_points, num_points:, 0]
+            noise_variance = gp.likelihood.variance
+
+        correlation = tf.abs(covariance) / noise_variance
+        return tf.reduce_max(correlation, axis=1)
+
     def update_feed_dict(self):
         """Update the feed dictionary for tensorflow."""
         gp = self.gaussian_process
@@ -585,6 +1494,12 @@ class GridWorld(object):
         self.ndim = len(self.limits)
         self._all_points = None
 
+        # Offsets of the flat index along each dimension
+        self.strides = np.append(np.cumprod(self.num_points[:0:-1])[::-1], 1)
+        self._neighbor_offsets = None
+        self._neighbor_strides = None
+        self._boundary_indices = None
+
     @property
     def all_points(self):
         """Return all the discrete points of the discretization.
@@ -601,6 +1516,121 @@ class GridWorld(object):
             self._all_points = points.astype(config.np_dtype)
         return self._all_points
 
+    @property
+    def neighbor_offsets(self):
+        """Return the offsets of the neighbors of a node, including diagonals.
+
+        Returns
+        -------
+        offsets : ndarray
+            An integer array with size (3 ** self.ndim - 1, self.ndim), where
+            each row is the offset of one neighbor along each dimension.
+        """
+        if self._neighbor_offsets is None:
+            offsets = cartesian(*[(0, -1, 1) for _ in range(self.ndim)])
+            self._neighbor_offsets = np.array(tuple(offsets)[1:])
+        return self._neighbor_offsets
+
+    @property
+    def neighbor_strides(self):
+        """Return the offsets of the neighbors of a node in the flat index.
+
+        Adding these to the index of a node that is not on the boundary
+        yields the indices of its neighbors, in the same order as
+        `neighbor_offsets`.
+        """
+        if self._neighbor_strides is None:
+            offsets = self.neighbor_offsets
+            self._neighbor_strides = offsets.dot(self.strides)
+        return self._neighbor_strides
+
+    @property
+    def boundary_indices(self):
+        """Return the indices of all nodes on the boundary of the grid.
+
+        Returns
+        -------
+        indices : ndarray
+            A sorted 1D array, in which each boundary node appears once.
+        """
+        if self._boundary_indices is None:
+            boundary = np.zeros(self.num_points, dtype=np.bool)
+            for i in range(self.ndim):
+                face = [slice(None)] * self.ndim
+                face[i] = [0, -1]
+                boundary[tuple(face)] = True
+            self._boundary_indices = np.flatnonzero(boundary)
+        return self._boundary_indices
+
+    def neighbors(self, indices):
+        """Return the indices of the neighbors of nodes.
+
+        Parameters
+        ----------
+        indices : ndarray
+            A 1D array of node indices.
+
+        Returns
+        -------
+        neighbors : ndarray
+            An integer array with size (len(indices), 3 ** self.ndim - 1),
+            where each row contains the neighbors of one node in the order of
+            `neighbor_offsets`. Neighbors outside of the grid are -1.
+        """
+        indices = np.atleast_1d(indices)
+        ijk_index = np.column_stack(np.unravel_index(indices,
+                                                     self.num_points))
+
+        neighbor_ijk = ijk_index[:, None, :] + self.neighbor_offsets
+        outside = np.any((neighbor_ijk < 0)
+                         | (neighbor_ijk >= self.num_points), axis=2)
+
+        neighbors = indices[:, None] + self.neighbor_strides
+        neighbors[outside] = -1
+        return neighbors
+
+    def point_batches(self, batch_size=None):
+        """Yield the discrete points in batches and in order.
+
+        In contrast to `all_points`, only one batch of points is held in
+        memory at a time.
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            The number of points in each batch. Defaults to
+            `config.gp_batch_size`. The last batch might be smaller.
+
+        Yields
+        ------
+        index : int
+            The index of the first point in the batch.
+        points : ndarray
+            An array with the points of the batch with size
+            (batch_size, self.ndim).
+        """
+        if batch_size is None:
+            batch_size = config.gp_batch_size
+
+        for index in range(0, self.nindex, batch_size):
+            indices = np.arange(index, min(index + batch_size, self.nindex))
+            yield index, self.index_to_state(indices)
+
+    def tf_all_points(self):
+        """Return a tensor that computes all the discrete points.
+
+        Only the discrete points along each dimension are stored in the
+        graph, the full grid is built when the tensor is evaluated.
+
+        Returns
+        -------
+        points : tf.Tensor
+            A tensor with size (self.nindex, self.ndim) that has the same
+            values as `all_points`.
+        """
+        mesh = tf.meshgrid(*self.discrete_points, indexing='ij')
+        return tf.stack([tf.reshape(col, [-1]) for col in mesh], axis=1)
+
     def __len__(self):
         """Return the number of points in the discretization."""
         return self.nindex
@@ -927,6 +1957,85 @@ class _Delaunay1D(object):
         return np.where(out_of_bounds, -1, 0)
 
 
+class _KuhnTriangulation(object):
+    """A triangulation of a hyperrectangle along its main diagonal.
+
+    The Kuhn (or Freudenthal) triangulation splits the hyperrectangle into
+    one simplex for each permutation of the dimensions. A point lies in the
+    simplex whose permutation sorts its relative coordinates in decreasing
+    order, so simplices are found in closed form rather than with a search.
+    The class has the same interface as scipy.spatial.Delaunay.
+
+    Parameters
+    ----------
+    unit_maxes : ndarray
+        The side lengths of the hyperrectangle, which has its lower corner
+        at the origin.
+    """
+
+    def __init__(self, unit_maxes):
+        """Initialization, see `_KuhnTriangulation`."""
+        super(_KuhnTriangulation, self).__init__()
+        self.unit_maxes = np.asarray(unit_maxes, dtype=config.np_dtype)
+        ndim = len(self.unit_maxes)
+
+        corners = np.array(list(cartesian((0, 1), repeat=ndim)))
+        self.points = corners * self.unit_maxes
+
+        # Starting at the origin, each simplex adds one unit vector at a time
+        # in the order of its permutation. The index of a corner is the
+        # binary number given by its coordinates.
+        order = np.array(list(permutations(range(ndim))), dtype=np.int)
+        steps = 2 ** (ndim - 1 - order)
+
+        # Coordinates that are sorted in decreasing order by each permutation
+        rows = np.arange(len(order))[:, None]
+        relative = np.empty_like(order)
+        relative[rows, order] = np.arange(ndim, 0, -1)
+        simplex_ids = self._simplex_ids(relative)
+
+        self.simplices = np.zeros((len(order), ndim + 1), dtype=np.int)
+        self.simplices[simplex_ids, 1:] = np.cumsum(steps, axis=1)
+        self.nsimplex = len(self.simplices)
+
+    @staticmethod
+    def _simplex_ids(relative):
+        """Return the simplex indices for points in relative coordinates.
+
+        The digits of the index in the factorial number system count, for
+        each dimension, the preceding dimensions with smaller coordinates.
+        This numbers the permutations without sorting.
+        """
+        simplex_ids = np.zeros(len(relative), dtype=np.int)
+        for i in range(1, relative.shape[1]):
+            smaller = relative[:, :i] < relative[:, i:i + 1]
+            simplex_ids += factorial(i) * np.sum(smaller, axis=1)
+        return simplex_ids
+
+    def find_simplex(self, points):
+        """Find the simplices containing the given points.
+
+        Parameters
+        ----------
+        points : ndarray
+            2D array of coordinates of points for which to find simplices.
+
+        Returns
+        -------
+        indices : ndarray
+            Indices of simplices containing each point. Points outside the
+            triangulation get the value -1.
+        """
+        relative = np.atleast_2d(points) / self.unit_maxes
+        simplex_ids = self._simplex_ids(relative)
+
+        tolerance = 100 * _EPS
+        outside = np.any((relative < -tolerance)
+                         | (relative > 1 + tolerance), axis=1)
+        simplex_ids[outside] = -1
+        return simplex_ids
+
+
 class _Triangulation(DeterministicFunction):
     """
     Efficient Delaunay triangulation on regular grids.
@@ -945,12 +2054,25 @@ class _Triangulation(DeterministicFunction):
         A 2D array with the values at the vertices of the grid on each row.
     project: bool, optional
         Whether to project points onto the limits.
+    method: {'delaunay', 'kuhn'}, optional
+        How to triangulate the hyperrectangles. 'delaunay' uses
+        scipy.spatial.Delaunay, while 'kuhn' uses the triangulation along the
+        main diagonal in `_KuhnTriangulation`, which finds simplices in closed
+        form and scales better to higher dimensions.
+    cache_size: int, optional
+        The memory in bytes that may be used to cache the matrices returned
+        by `parameter_derivative`. The least recently used matrices are
+        evicted first. Set to zero to disable the cache.
     """
 
-    def __init__(self, discretization, vertex_values=None, project=False):
+    def __init__(self, discretization, vertex_values=None, project=False,
+                 method='delaunay', cache_size=0):
         """Initialization."""
         super(_Triangulation, self).__init__()
 
+        if method not in ('delaunay', 'kuhn'):
+            raise ValueError('Unknown method: {}'.format(method))
+
         self.discretization = discretization
         self.input_dim = discretization.ndim
 
@@ -963,6 +2085,8 @@ class _Triangulation(DeterministicFunction):
         if len(disc.limits) == 1:
             corners = np.array([[0], disc.unit_maxes])
             self.triangulation = _Delaunay1D(corners)
+        elif method == 'kuhn':
+            self.triangulation = _KuhnTriangulation(disc.unit_maxes)
         else:
             product = cartesian(*np.diag(disc.unit_maxes))
             hyperrectangle_corners = np.array(list(product),
@@ -979,6 +2103,13 @@ class _Triangulation(DeterministicFunction):
 
         self.project = project
 
+        # LRU cache for parameter_derivative
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._derivative_cache = OrderedDict()
+        self._derivative_cache_bytes = 0
+
     @property
     def output_dim(self):
         """Return the output dimensions of the function."""
@@ -1176,6 +2307,10 @@ class _Triangulation(DeterministicFunction):
         with the vector with all the function values on the vertices,
         returns the function values at points.
 
+        If `cache_size` is positive, the matrices are cached, keyed by a hash
+        of the points. Cached matrices are shared between calls and must not
+        be modified. `cache_hits` and `cache_misses` count the cache lookups.
+
         Parameters
         ----------
         points : 2d array
@@ -1183,10 +2318,58 @@ class _Triangulation(DeterministicFunction):
 
         Returns
         -------
-        values
+        values : scipy.sparse.csr_matrix
             A sparse matrix B so that evaluate(points) = B.dot(parameters).
         """
         points = np.atleast_2d(points)
+        if self.cache_size <= 0:
+            return self._parameter_derivative(points).tocsr()
+
+        points = np.ascontiguousarray(points)
+        key = (hashlib.sha1(points.view(np.uint8)).hexdigest(),
+               points.shape, points.dtype.str, self.project)
+
+        cache = self._derivative_cache
+        if key in cache:
+            self.cache_hits += 1
+            # Mark as most recently used
+            matrix = cache[key] = cache.pop(key)
+            return matrix
+
+        self.cache_misses += 1
+        matrix = self._parameter_derivative(points).tocsr()
+        nbytes = (matrix.data.nbytes + matrix.indices.nbytes
+                  + matrix.indptr.nbytes)
+
+        if nbytes <= self.cache_size:
+            # Evict least recently used matrices
+            while self._derivative_cache_bytes + nbytes > self.cache_size:
+                _, evicted = cache.popitem(last=False)
+                self._derivative_cache_bytes -= (evicted.data.nbytes
+                                                 + evicted.indices.nbytes
+                                                 + evicted.indptr.nbytes)
+            cache[key] = matrix
+            self._derivative_cache_bytes += nbytes
+
+        return matrix
+
+    def clear_cache(self):
+        """Remove all matrices from the parameter_derivative cache."""
+        self._derivative_cache.clear()
+        self._derivative_cache_bytes = 0
+
+    def _parameter_derivative(self, points):
+        """Assemble the matrix for `parameter_derivative` without the cache.
+
+        Parameters
+        ----------
+        points : 2d array
+            Each row represents one point.
+
+        Returns
+        -------
+        values : scipy.sparse.coo_matrix
+        """
         weights, simplices = self._get_weights(points)
         # Construct sparse matrix for optimization
 
@@ -1330,16 +2513,23 @@ class Triangulation(DeterministicFunction):
         Whether to project points onto the limits.
     name : string
         The tensorflow scope for all methods.
+    method : {'delaunay', 'kuhn'}, optional
+        How to triangulate the hyperrectangles, see `_Triangulation`.
+    cache_size : int, optional
+        The memory in bytes for the cache of `tri.parameter_derivative`, see
+        `_Triangulation`.
     """
 
     def __init__(self, discretization, vertex_values, project=False,
-                 name='triangulation'):
+                 name='triangulation', method='delaunay', cache_size=0):
         """Initialization."""
         super(Triangulation, self).__init__(name=name)
 
         with tf.variable_scope(self.scope_name):
             self.tri = _Triangulation(discretization,
-                                      project=project)
+                                      project=project,
+                                      method=method,
+                                      cache_size=cache_size)
 
             # Make sure the variable has the correct size
             if not isinstance(vertex_values, tf.Variable):
@@ -1515,7 +2705,8 @@ class LinearSystem(DeterministicFunction):
 
 
 @with_scope('sample_gp_function')
-def sample_gp_function(discretization, gpfun, number=1, return_function=True):
+def sample_gp_function(discretization, gpfun, number=1, return_function=True,
+                       method='exact', num_features=1000):
     """
     Sample a function from a gp with corresponding kernel within its bounds.
 
@@ -1530,6 +2721,14 @@ def sample_gp_function(discretization, gpfun, number=1, return_function=True):
         The number of functions to sample.
     return_function : bool, optional
         Whether to return a function or the sampled data only.
+    method : str, optional
+        Either 'exact', which draws a sample from the joint distribution over
+        all points in the discretization, or 'fourier', which approximates
+        the kernel with random Fourier features. The latter scales linearly
+        with the number of points, but only supports the stationary
+        `gpflow.kernels.RBF` and Matern kernels.
+    num_features : int, optional
+        The number of random Fourier features for the 'fourier' method.
 
     Returns
     -------
@@ -1540,6 +2739,12 @@ def sample_gp_function(discretization, gpfun, number=1, return_function=True):
         noise=False is set the true function values are returned (useful for
         plotting).
     """
+    if method == 'fourier':
+        return _sample_gp_function_fourier(discretization, gpfun, number,
+                                           return_function, num_features)
+    elif method != 'exact':
+        raise ValueError('Unknown sampling method: {}'.format(method))
+
     if isinstance(discretization, GridWorld):
         discretization = discretization.all_points
 
@@ -1592,6 +2797,128 @@ def sample_gp_function(discretization, gpfun, number=1, return_function=True):
     return functions
 
 
+def _fourier_frequencies(kernel, input_dim, num_features):
+    """Sample frequencies from the spectral density of a stationary kernel.
+
+    Parameters
+    ----------
+    kernel : instance of gpflow.kernels.Stationary
+        Either an RBF kernel or a Matern kernel.
+    input_dim : int
+    num_features : int
+
+    Returns
+    -------
+    frequencies : ndarray
+        A (num_features x input_dim) array of frequencies.
+    """
+    frequencies = np.random.randn(num_features, input_dim)
+
+    # The spectral density of a Matern kernel is a student-t distribution
+    matern_nu = {gpflow.kernels.Matern12: 0.5,
+                 gpflow.kernels.Matern32: 1.5,
+                 gpflow.kernels.Matern52: 2.5}
+    for kernel_type, nu in matern_nu.items():
+        if isinstance(kernel, kernel_type):
+            scaling = np.random.chisquare(2 * nu, size=(num_features, 1))
+            frequencies /= np.sqrt(scaling / (2 * nu))
+            break
+    else:
+        if not isinstance(kernel, gpflow.kernels.RBF):
+            raise ValueError('Random Fourier features are only supported '
+                             'for RBF and Matern kernels.')
+
+    return frequencies / kernel.lengthscales.value
+
+
+def _sample_gp_function_fourier(discretization, gpfun, number,
+                                return_function, num_features):
+    """Sample GP functions with random Fourier features.
+
+    Samples from the prior are approximated with random Fourier features and
+    conditioned on the data of the GP through pathwise updates, see
+    `sample_gp_function` for the parameters.
+    """
+    gp = gpfun.gaussian_process
+    x_data = gp.X.value
+    y_data = gp.Y.value
+
+    frequencies = _fourier_frequencies(gp.kern, x_data.shape[1],
+                                       num_features)
+    phases = np.random.uniform(0, 2 * np.pi, size=num_features)
+    scaling = np.sqrt(2 * np.squeeze(gp.kern.variance.value) / num_features)
+
+    # Weights of the features, one column for each sample
+    weights = np.random.randn(num_features, number)
+
+    def build_prior(x, weights):
+        """Evaluate the prior samples at x."""
+        features = tf.cos(tf.matmul(x, frequencies.T) + phases)
+        with gp.tf_mode():
+            return gp.mean_function(x) + scaling * tf.matmul(features,
+                                                             weights)
+
+    def build_sample(x, weights, update):
+        """Evaluate the posterior samples at x."""
+        y = build_prior(x, weights)
+        with gp.tf_mode():
+            return y + tf.matmul(gp.kern.K(x, x_data), update)
+
+    # Update the samples so that they are conditioned on the data
+    sess = tf.get_default_session()
+    with gp.tf_mode():
+        kernel = (gp.kern.K(x_data)
+                  + gp.likelihood.variance * tf.eye(len(x_data),
+                                                    dtype=config.dtype))
+    kernel, prior = sess.run([kernel, build_prior(x_data, weights)],
+                             feed_dict=gpfun.feed_dict)
+
+    noise = np.sqrt(np.squeeze(gp.likelihood.variance.value))
+    residuals = y_data - prior - noise * np.random.randn(*prior.shape)
+    updates = linalg.cho_solve(linalg.cho_factor(kernel, lower=True),
+                               residuals)
+
+    if not return_function:
+        if isinstance(discretization, GridWorld):
+            num_points = discretization.nindex
+            batches = discretization.point_batches()
+        else:
+            num_points = len(discretization)
+            batches = ((i, points) for i, (points,)
+                       in batchify(discretization, config.gp_batch_size))
+
+        points = tf.placeholder(config.dtype, [None, x_data.shape[1]])
+        values = build_sample(points, weights, updates)
+
+        output = np.empty((number, num_points), dtype=config.np_dtype)
+        feed_dict = gpfun.feed_dict.copy()
+        for i, batch in batches:
+            feed_dict[points] = batch
+            output[:, i:i + len(batch)] = sess.run(values,
+                                                   feed_dict=feed_dict).T
+        return output
+
+    @concatenate_inputs(start=2)
+    def gp_sample(weights, update, x, noise=True):
+        y = build_sample(x, weights, update)
+        if noise:
+            with gp.tf_mode():
+                y += (tf.sqrt(gp.likelihood.variance)
+                      * tf.random_normal(tf.shape(y), dtype=tf.float64))
+        return y
+
+    functions = []
+    for i in range(number):
+        fun = partial(gp_sample, weights[:, [i]], updates[:, [i]])
+
+        # Attach the feed_dict for ease of use
+        fun.feed_dict = gpfun.feed_dict
+
+        functions.append(fun)
+
+    return functions
+
+
 class NeuralNetwork(DeterministicFunction):
     """A simple neural network.
 
@@ -5,66 +5,235 @@ from __future__ import absolute_import, division, print_function
 from collections import Sequence
 from heapq import heappush, heappop
 import itertools
+from multiprocessing.pool import ThreadPool
 from future.builtins import zip, range
 
 import numpy as np
 import tensorflow as tf
+from scipy import ndimage, sparse
+from scipy.sparse import csgraph
 
+from .functions import Function, GaussianProcess
 from .utilities import (batchify, get_storage, set_storage, with_scope,
-                        get_feed_dict, unique_rows)
+                        get_feed_dict, unique_rows, parameter_token)
 from safe_learning import config
 
 __all__ = ['Lyapunov', 'smallest_boundary_value', 'get_lyapunov_region',
            'get_safe_sample']
 
+_STORAGE = {}
+
+
+def _waves(iterable, size):
+    """Split an iterable into consecutive lists of (at most) size elements."""
+    iterator = iter(iterable)
+    wave = list(itertools.islice(iterator, size))
+    while wave:
+        yield wave
+        wave = list(itertools.islice(iterator, size))
+
+
+def _galloping_rounds(arrays, batch_size, num_batches=1):
+    """Yield batches of arrays in rounds that double the verified prefix.
+
+    The first round covers num_batches batches and every following round
+    covers as many elements as all previous rounds together. If the first
+    violation is in batch b, it is reached after O(log(b / num_batches))
+    rounds and fewer than 2 * max(b, num_batches) batches are verified. The
+    batches are the same as for `batchify`, only their grouping into rounds
+    differs.
+
+    Parameters
+    ----------
+    arrays : list of ndarray
+        The arrays that we want to convert to batches.
+    batch_size : int
+        The size of each individual batch.
+    num_batches : int, optional
+        The number of batches in the first round.
+
+    Yields
+    ------
+    batches : list
+        The batches of the round in the same format as `batchify`.
+    """
+    num_elements = len(arrays[0])
+    start = 0
+    end = num_batches * batch_size
+    while start < num_elements:
+        shell = [array[start:end] for array in arrays]
+        yield [(start + i, batches)
+               for i, batches in batchify(shell, batch_size)]
+        start = end
+        end *= 2
+
 
-def smallest_boundary_value(fun, discretization):
+def _map_rounds(function, rounds, num_workers=1):
+    """Apply a function to all elements, one round of elements at a time.
+
+    Parameters
+    ----------
+    function : callable
+    rounds : iterable
+        An iterable that yields lists of elements.
+    num_workers : int, optional
+        If larger than one, the elements of each round are processed
+        concurrently by a pool of threads. Otherwise, they are processed
+        lazily one at a time. Stopping the iteration early means that no
+        further rounds are started.
+
+    Yields
+    ------
+    result
+        The output of the function for each element, in the original order.
+    """
+    if num_workers <= 1:
+        for elements in rounds:
+            for element in elements:
+                yield function(element)
+        return
+
+    pool = ThreadPool(num_workers)
+    try:
+        for elements in rounds:
+            for result in pool.map(function, elements):
+                yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def smallest_boundary_value(fun, discretization=None):
     """Determine the smallest value of a function on its boundary.
 
     Parameters
     ----------
-    fun : callable
-        A tensorflow function that we want to evaluate.
-    discretization : instance of `GridWorld`
-        The discretization. If None, then the function is assumed to be
-        defined on a discretization already.
+    fun : callable or instance of `Lyapunov`
+        A tensorflow function that we want to evaluate. If it is a `Lyapunov`
+        instance, the precomputed `Lyapunov.values` are read without running
+        tensorflow, so they must be up-to-date (see `Lyapunov.update_values`).
+    discretization : instance of `GridWorld`, optional
+        The discretization. Can only be None if fun is a `Lyapunov`
+        instance, in which case its discretization is used.
 
     Returns
     -------
     min_value : float
         The smallest value on the boundary.
     """
-    min_value = np.inf
+    if isinstance(fun, Lyapunov):
+        if discretization in (None, fun.discretization):
+            boundary = fun.discretization.boundary_indices
+            return np.min(fun.values[boundary])
+        fun = fun.lyapunov_function
+
     feed_dict = get_feed_dict(tf.get_default_graph())
+    values = _evaluate_on_grid(fun, discretization, feed_dict,
+                               indices=discretization.boundary_indices)
+    return np.min(values)
+
+
+def _graph_storage(graph):
+    """Return the storage of the evaluation graphs for plain functions.
+
+    The storage is kept on the graph, so that it is discarded together with
+    the graph elements that it contains.
+
+    Parameters
+    ----------
+    graph : tf.Graph
+
+    Returns
+    -------
+    storage : dict
+    """
+    try:
+        return graph.evaluation_storage_sl
+    except AttributeError:
+        graph.evaluation_storage_sl = {}
+        return graph.evaluation_storage_sl
+
+
+def _evaluate_on_grid(fun, discretization, feed_dict=None, indices=None):
+    """Evaluate a scalar function on the points of a discretization.
+
+    The points are generated and evaluated in batches of size
+    `config.gp_batch_size`, so that `discretization.all_points` is never
+    built. The evaluation graph is reused across calls.
+
+    Parameters
+    ----------
+    fun : callable
+        A tensorflow function that returns one value for each state.
+    discretization : instance of `GridWorld`
+        The discretization on which to evaluate the function.
+    feed_dict : dict, optional
+        Additional values for the evaluation.
+    indices : ndarray, optional
+        The indices of the points at which to evaluate the function.
+        Defaults to all points.
+
+    Returns
+    -------
+    values : ndarray
+        A 1D array with the function value at each point.
+    """
+    if isinstance(fun, Function):
+        # Reuses the evaluation graph across calls
+        evaluate = fun.evaluate
+    else:
+        feed_dict = {} if feed_dict is None else feed_dict.copy()
 
-    # Check boundaries for each axis
-    for i in range(discretization.ndim):
-        # Use boundary values only for the ith element
-        tmp = list(discretization.discrete_points)
-        tmp[i] = discretization.discrete_points[i][[0, -1]]
+        graph_storage = _graph_storage(tf.get_default_graph())
+        storage = get_storage(graph_storage, index=fun)
+        if storage is None:
+            tf_states = tf.placeholder(config.dtype,
+                                       shape=[None, discretization.ndim],
+                                       name='states')
+            tf_values = tf.reshape(fun(tf_states), [-1])
+
+            storage = [('states', tf_states), ('values', tf_values)]
+            set_storage(graph_storage, storage, index=fun)
+        else:
+            tf_states, tf_values = storage.values()
+
+        def evaluate(points):
+            """Evaluate the function on a batch of points."""
+            feed_dict[tf_states] = points
+            return tf_values.eval(feed_dict=feed_dict)
 
-        # Generate all points
-        columns = (x.ravel() for x in np.meshgrid(*tmp, indexing='ij'))
-        all_points = np.column_stack(columns)
+    if indices is None:
+        values = np.empty(discretization.nindex, dtype=config.np_dtype)
+        batches = discretization.point_batches()
+    else:
+        values = np.empty(len(indices), dtype=config.np_dtype)
+        batches = ((i, discretization.index_to_state(batch))
+                   for i, (batch,) in batchify(indices, config.gp_batch_size))
 
-        # Update the minimum value
-        smallest = tf.reduce_min(fun(all_points))
-        min_value = min(min_value, smallest.eval(feed_dict=feed_dict))
+    for i, points in batches:
+        values[i:i + len(points)] = np.ravel(evaluate(points))
 
-    return min_value
+    return values
 
 
-def get_lyapunov_region(lyapunov, discretization, init_node):
+def get_lyapunov_region(lyapunov, discretization, init_node, method='heap'):
     """Get the region within which a function is a Lyapunov function.
 
     Parameters
     ----------
-    lyapunov : callable
-        A tensorflow function.
+    lyapunov : callable or instance of `Lyapunov`
+        A tensorflow function. For a `Lyapunov` instance with the same
+        discretization, the values from `Lyapunov.get_values` are used.
     discretization : instance of `GridWorld`
         The discretization on which to check the increasing property.
     init_node : tuple
         The node at which to start the verification.
+    method : {'heap', 'sweep'}, optional
+        The 'heap' method expands the region one node at a time with a
+        best-first search in Python. The 'sweep' method bisects over the
+        sorted values instead and labels sublevel sets with vectorized
+        operations, which is much faster on large grids. Both methods return
+        the same region.
 
     Returns
     -------
@@ -72,37 +241,73 @@ def get_lyapunov_region(lyapunov, discretization, init_node):
         A boolean array that contains all the states for which lyapunov is a
         Lyapunov function that can be used for stability verification.
     """
-    # Turn values into a multi-dim array
-    feed_dict = lyapunov.feed_dict
+    if (isinstance(lyapunov, Lyapunov)
+            and lyapunov.discretization is discretization):
+        values = lyapunov.get_values()
+    else:
+        if isinstance(lyapunov, Lyapunov):
+            lyapunov = lyapunov.lyapunov_function
+        values = _evaluate_on_grid(lyapunov, discretization,
+                                   get_feed_dict(tf.get_default_graph()))
+    init_index = np.ravel_multi_index(tuple(init_node),
+                                      discretization.num_points)
+
+    if method == 'heap':
+        region = _heap_lyapunov_region(values, discretization, init_index)
+    elif method == 'sweep':
+        region = _sweep_lyapunov_region(values, discretization, init_index)
+    else:
+        raise ValueError('Unknown method: {}'.format(method))
 
-    values = lyapunov(discretization.all_points).eval(feed_dict=feed_dict)
-    lyapunov_values = values.reshape(discretization.num_points)
+    # Turn the region into a multi-dim array
+    return region.reshape(discretization.num_points)
 
-    # Starting point for the verification
-    init_value = lyapunov_values[init_node]
 
-    ndim = discretization.ndim
-    num_points = discretization.num_points
+def _boundary_mask(discretization):
+    """Return a boolean array that is True for nodes on the boundary."""
+    boundary = np.zeros(discretization.nindex, dtype=np.bool)
+    boundary[discretization.boundary_indices] = True
+    return boundary
+
 
-    # Indeces for generating neighbors
-    index_generator = itertools.product(*[(0, -1, 1) for _ in range(ndim)])
-    neighbor_indeces = np.array(tuple(index_generator)[1:])
+def _heap_lyapunov_region(lyapunov_values, discretization, init_index):
+    """Get the Lyapunov region with a best-first search.
+
+    Parameters
+    ----------
+    lyapunov_values : ndarray
+        A 1D array with the values of the Lyapunov function on the grid.
+    discretization : instance of `GridWorld`
+        The discretization of the values.
+    init_index : int
+        The index of the node at which to start the verification.
+
+    Returns
+    -------
+    region : ndarray
+        A boolean array with the same shape as lyapunov_values.
+    """
+    # Starting point for the verification
+    init_value = lyapunov_values[init_index]
+
+    boundary = _boundary_mask(discretization)
+    neighbor_strides = discretization.neighbor_strides
 
     # Array keeping track of visited nodes
-    visited = np.zeros(discretization.num_points, dtype=np.bool)
-    visited[init_node] = True
+    visited = np.zeros(lyapunov_values.shape, dtype=np.bool)
+    visited[init_index] = True
 
     # Create priority queue
     tiebreaker = itertools.count()
     last_value = init_value
-    priority_queue = [(init_value, tiebreaker.next(), init_node)]
+    priority_queue = [(init_value, next(tiebreaker), init_index)]
 
     while priority_queue:
-        value, _, next_node = heappop(priority_queue)
+        value, _, node = heappop(priority_queue)
 
         # Check if we reached the boundary of the discretization
-        if np.any(0 == next_node) or np.any(next_node == num_points - 1):
-            visited[tuple(next_node)] = False
+        if boundary[node]:
+            visited[node] = False
             break
 
         # Make sure we are in the positive definite part of the function.
@@ -111,31 +316,182 @@ def get_lyapunov_region(lyapunov, discretization, init_node):
 
         last_value = value
 
-        # Get all neighbors
-        neighbors = next_node + neighbor_indeces
+        # Get all neighbors, which are within the grid for interior nodes
+        neighbors = node + neighbor_strides
 
         # Remove neighbors that are already part of the visited set
-        is_new = ~visited[np.split(neighbors.T, ndim)]
-        neighbors = neighbors[is_new[0]]
+        neighbors = neighbors[~visited[neighbors]]
 
         if neighbors.size:
-            indices = np.split(neighbors.T, ndim)
             # add to visited set
-            visited[indices] = True
-            # get values
-            values = lyapunov_values[indices][0]
+            visited[neighbors] = True
 
             # add to priority queue
-            for value, neighbor in zip(values, neighbors):
+            for value, neighbor in zip(lyapunov_values[neighbors], neighbors):
                 heappush(priority_queue, (value, next(tiebreaker), neighbor))
 
     # Prune nodes that were neighbors, but haven't been visited
     for _, _, node in priority_queue:
-        visited[tuple(node)] = False
+        visited[node] = False
 
     return visited
 
 
+def _regional_minima(values, discretization):
+    """Return the regional minima of a function on a grid.
+
+    A regional minimum is a connected plateau of nodes with equal values,
+    none of which has a neighbor with a lower value.
+
+    Parameters
+    ----------
+    values : ndarray
+        The function values, with one array dimension for each grid dimension.
+    discretization : instance of `GridWorld`
+        The discretization of the values.
+
+    Returns
+    -------
+    minima : ndarray
+        A boolean array that is True for all nodes in a regional minimum.
+    plateaus : ndarray
+        An integer array that assigns a unique label to each plateau.
+    """
+    # The border is padded with the nearest values, which are never lower
+    has_lower = ndimage.minimum_filter(values, size=3, mode='nearest') < values
+
+    # Connect neighboring nodes with equal values. Each offset is the
+    # negative of another one, so the offsets whose first nonzero element is
+    # positive are sufficient for an undirected graph.
+    index = np.arange(values.size).reshape(values.shape)
+    offsets = discretization.neighbor_offsets
+    first_nonzero = np.argmax(offsets != 0, axis=1)
+    offsets = offsets[offsets[np.arange(len(offsets)), first_nonzero] > 0]
+    rows, cols = [], []
+    for offset in offsets:
+        source = tuple(slice(max(0, -o), n - max(0, o))
+                       for o, n in zip(offset, values.shape))
+        target = tuple(slice(max(0, o), n - max(0, -o))
+                       for o, n in zip(offset, values.shape))
+        equal = values[source] == values[target]
+        rows.append(index[source][equal])
+        cols.append(index[target][equal])
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    edges = sparse.coo_matrix((np.ones(len(rows), dtype=np.bool),
+                               (rows, cols)),
+                              shape=(values.size, values.size))
+    num_plateaus, plateaus = csgraph.connected_components(edges,
+                                                          directed=False)
+
+    plateau_has_lower = np.bincount(plateaus,
+                                    weights=has_lower.ravel(),
+                                    minlength=num_plateaus) > 0
+    minima = ~plateau_has_lower[plateaus]
+    return minima.reshape(values.shape), plateaus.reshape(values.shape)
+
+
+def _sweep_lyapunov_region(lyapunov_values, discretization, init_index):
+    """Get the Lyapunov region by bisecting over sublevel sets.
+
+    The best-first search in `_heap_lyapunov_region` visits the connected
+    component of the sublevel set around init_index in order of increasing
+    values. It stops at the first level where this component contains a
+    boundary node or a regional minimum other than the one of init_index (the
+    values decrease again). Since both conditions are monotone in the level,
+    the stopping level can be found by bisection, where each step labels the
+    connected components of one sublevel set. The region consists of the
+    component of the sublevel set strictly below the stopping level and the
+    nodes that the heap visits at the stopping level. If the latter depends
+    on the order in which tied nodes were discovered, the heap is used.
+
+    Parameters
+    ----------
+    lyapunov_values : ndarray
+        A 1D array with the values of the Lyapunov function on the grid.
+    discretization : instance of `GridWorld`
+        The discretization of the values.
+    init_index : int
+        The index of the node at which to start the verification.
+
+    Returns
+    -------
+    region : ndarray
+        A boolean array with the same shape as lyapunov_values.
+    """
+    ndim = discretization.ndim
+    init_value = lyapunov_values[init_index]
+
+    # Neighbors include diagonals, same as for the heap
+    structure = ndimage.generate_binary_structure(ndim, ndim)
+    grid_values = lyapunov_values.reshape(discretization.num_points)
+
+    boundary = _boundary_mask(discretization)
+
+    minima, plateaus = _regional_minima(grid_values, discretization)
+    minima, plateaus = minima.ravel(), plateaus.ravel()
+    other_minima = minima & (plateaus != plateaus[init_index])
+
+    def sublevel_component(level):
+        """Return the component of the sublevel set around init_index."""
+        labels, _ = ndimage.label(grid_values <= level, structure=structure)
+        labels = labels.ravel()
+        return labels == labels[init_index]
+
+    def stops(level):
+        """Check whether the search stops at or below the level."""
+        component = sublevel_component(level)
+        return np.any(component & (boundary | other_minima))
+
+    # Find the smallest level at which the search stops
+    levels = np.unique(lyapunov_values[lyapunov_values >= init_value])
+    low, high = 0, len(levels) - 1
+    while low < high:
+        middle = (low + high) // 2
+        if stops(levels[middle]):
+            high = middle
+        else:
+            low = middle + 1
+    level = levels[low]
+
+    # All nodes below the stopping level are part of the region
+    if low > 0:
+        region = sublevel_component(levels[low - 1])
+        candidates = ndimage.binary_dilation(
+            region.reshape(grid_values.shape), structure=structure).ravel()
+        candidates &= ~region & (lyapunov_values == level)
+    else:
+        region = np.zeros(lyapunov_values.shape, dtype=np.bool)
+        candidates = region.copy()
+        candidates[init_index] = True
+
+    # The heap pops the candidates at the stopping level in the order in
+    # which they were discovered and stops at the first boundary node
+    if np.all(boundary[candidates]):
+        return region
+    if np.count_nonzero(candidates) > 1:
+        # The order of tied candidates depends on the whole search
+        return _heap_lyapunov_region(lyapunov_values, discretization,
+                                     init_index)
+
+    # The search visits the node and then the lowest unvisited neighbor
+    node = np.flatnonzero(candidates)[0]
+    region[node] = True
+
+    neighbors = node + discretization.neighbor_strides
+    neighbor_values = lyapunov_values[neighbors]
+    lower = (neighbor_values < level) & ~region[neighbors]
+    if not np.any(lower):
+        # The search continues on a plateau at the stopping level
+        return _heap_lyapunov_region(lyapunov_values, discretization,
+                                     init_index)
+
+    lowest = neighbors[lower][np.argmin(neighbor_values[lower])]
+    region[lowest] = not boundary[lowest]
+    return region
+
+
 class Lyapunov(object):
     """A class for general Lyapunov functions.
 
@@ -165,11 +521,15 @@ class Lyapunov(object):
         discretization).
     initial_set : ndarray, optional
         A boolean array of states that are known to be safe a priori.
+    values_file : str, optional
+        A file in which to store the values of the Lyapunov function on the
+        discretization as a memory-mapped array, for discretizations that do
+        not fit into memory.
     """
 
     def __init__(self, discretization, lyapunov_function, dynamics,
                  lipschitz_dynamics, lipschitz_lyapunov,
-                 epsilon, policy, initial_set=None):
+                 epsilon, policy, initial_set=None, values_file=None):
         """Initialization, see `Lyapunov` for details."""
         super(Lyapunov, self).__init__()
 
@@ -184,6 +544,11 @@ class Lyapunov(object):
         if initial_set is not None:
             self.safe_set[initial_set] = True
 
+        # Decrease bounds relative to the threshold from the last
+        # verification, nan for states that were not verified
+        self._decrease_margin = np.full(len(self.safe_set), np.nan,
+                                        dtype=config.np_dtype)
+
         # Discretization constant
         self.epsilon = epsilon
 
@@ -197,8 +562,19 @@ class Lyapunov(object):
         self._storage = dict()
         self.feed_dict = get_feed_dict(tf.get_default_graph())
 
-        # Lyapunov values
-        self.values = None
+        # Lyapunov values, updated in place by update_values. The version is
+        # incremented with every update and the token identifies the
+        # parameters of the Lyapunov function that the values belong to.
+        # Consumers reevaluate invalidated values through get_values.
+        if values_file is None:
+            self.values = np.empty(len(self.safe_set),
+                                   dtype=config.np_dtype)
+        else:
+            self.values = np.memmap(values_file, dtype=config.np_dtype,
+                                    mode='w+', shape=(len(self.safe_set),))
+        self.values_version = 0
+        self._values_token = None
+        self._values_valid = False
 
         self.c_max = tf.placeholder(config.dtype, shape=())
         self.feed_dict[self.c_max] = 0.
@@ -275,10 +651,84 @@ class Lyapunov(object):
         """
         return self.safe_set[self.discretization.state_to_index(state)]
 
+    @with_scope('update_values')
     def update_values(self):
-        """Update the discretized values when the Lyapunov function changes."""
-        points = self.discretization.all_points
-        self.values = self.lyapunov_function(points).eval().squeeze()
+        """Update the discretized values when the Lyapunov function changes.
+
+        The values are evaluated in batches of size `config.gp_batch_size`
+        and written into `self.values` in place.
+        """
+        storage = get_storage(self._storage)
+
+        if storage is None:
+            tf_states = tf.placeholder(config.dtype,
+                                       shape=[None, self.discretization.ndim],
+                                       name='states')
+            tf_values = tf.reshape(self.lyapunov_function(tf_states), [-1])
+
+            storage = [('states', tf_states), ('values', tf_values)]
+            set_storage(self._storage, storage)
+        else:
+            tf_states, tf_values = storage.values()
+
+        if self.values is None or len(self.values) != len(self.safe_set):
+            self.values = np.empty(len(self.safe_set), dtype=config.np_dtype)
+
+        feed_dict = self.feed_dict.copy()
+        for i, points in self.discretization.point_batches():
+            feed_dict[tf_states] = points
+            self.values[i:i + len(points)] = tf_values.eval(feed_dict)
+
+        self.values_version += 1
+        self._values_token = self._parameter_token()
+        self._values_valid = True
+
+    def invalidate_values(self):
+        """Mark the values as outdated after the Lyapunov function changed.
+
+        The values are reevaluated by the next call to `get_values`, e.g.,
+        from `update_safe_set`. Call this after training steps that change
+        the parameters of the Lyapunov function.
+        """
+        self._values_valid = False
+
+    def _parameter_token(self):
+        """Return a token that identifies the current parameter values.
+
+        Returns
+        -------
+        token : str
+            A hash of the parameters of the Lyapunov function. None if the
+            Lyapunov function does not expose any numpy arrays or tensorflow
+            variables as parameters, in which case no session is run.
+        """
+        parameters = getattr(self.lyapunov_function, 'parameters', None)
+        return parameter_token(parameters, feed_dict=self.feed_dict)
+
+    def get_values(self, check_parameters=False):
+        """Return the values of the Lyapunov function on the discretization.
+
+        The values are only reevaluated if they were marked as outdated with
+        `invalidate_values` since the last call to `update_values`.
+
+        Parameters
+        ----------
+        check_parameters : bool, optional
+            Whether to also reevaluate the values if the parameters of the
+            Lyapunov function changed since the last call to `update_values`.
+            This runs the session once to fetch all parameters.
+
+        Returns
+        -------
+        values : ndarray
+            The array `self.values`, which is shared between all consumers.
+        """
+        outdated = not self._values_valid
+        if check_parameters and not outdated:
+            outdated = self._parameter_token() != self._values_token
+        if outdated:
+            self.update_values()
+        return self.values
 
     def v_decrease_confidence(self, states, next_states):
         """
@@ -363,8 +813,38 @@ class Lyapunov(object):
         return v_dot_negative
 
     @with_scope('update_safe_set')
-    def update_safe_set(self):
-        """Compute and update the safe set."""
+    def update_safe_set(self, num_workers=None, strategy='linear',
+                        new_data=None):
+        """Compute and update the safe set.
+
+        Parameters
+        ----------
+        num_workers : int, optional
+            The number of batches that are verified concurrently, each with
+            its own `session.run` call. Defaults to `config.num_workers`. The
+            resulting safe set does not depend on the number of workers.
+        strategy : {'linear', 'galloping'}, optional
+            How to search for the largest safe level set. 'linear' verifies
+            the states in order of increasing values in waves of
+            `num_workers` batches. 'galloping' doubles the candidate
+            sublevel set in every round, starting from `num_workers`
+            batches, and distributes all batches of a candidate among the
+            workers at once. This only helps with more than one worker: a
+            safe region with N states is then covered after O(log(N)) rounds
+            instead of O(N) waves, while at most twice as many states as
+            with 'linear' are verified. With a single worker, both
+            strategies verify the same batches in the same order. Both
+            strategies result in the same safe set.
+        new_data : ndarray, optional
+            The state-action pairs that were added to the dynamics model
+            since the last call, one on each row. If provided, the decrease
+            bounds from previous calls are reused for states at which the
+            new data points changed the prediction by at most
+            `config.correlation_tolerance` times their residuals. This
+            requires the dynamics to provide a `correlation` method (e.g.,
+            `GaussianProcess`) and assumes that nothing but the data of the
+            model changed since the last call.
+        """
         storage = get_storage(self._storage)
 
         if storage is None:
@@ -377,20 +857,50 @@ class Lyapunov(object):
 
             decrease = self.v_decrease_bound(tf_states, next_states)
             threshold = self.threshold(tf_states)
-            tf_negative = tf.squeeze(tf.less(decrease, threshold), axis=1)
-
-            storage = [('tf_states', tf_states), ('negative', tf_negative)]
+            tf_margin = tf.squeeze(decrease - threshold, axis=1)
+
+            # Correlation between the model inputs and new data points
+            if hasattr(self.dynamics, 'correlation'):
+                tf_new_data = tf.placeholder(config.dtype,
+                                             shape=[None, None],
+                                             name='new_data')
+                inputs = tf.concat((tf_states, tf_actions), axis=1)
+                tf_correlation = self.dynamics.correlation(inputs,
+                                                           tf_new_data)
+            else:
+                tf_new_data = tf_correlation = None
+
+            storage = [('tf_states', tf_states), ('margin', tf_margin),
+                       ('tf_new_data', tf_new_data),
+                       ('correlation', tf_correlation)]
             set_storage(self._storage, storage)
         else:
-            tf_states, tf_negative = storage.values()
+            tf_states, tf_margin, tf_new_data, tf_correlation = \
+                storage.values()
 
         # Get relevant properties
         feed_dict = self.feed_dict
         batch_size = config.gp_batch_size
+        if num_workers is None:
+            num_workers = config.num_workers
+        if strategy not in ('linear', 'galloping'):
+            raise ValueError('Unknown strategy: {}'.format(strategy))
+
+        margins = self._decrease_margin
+        if new_data is None:
+            # Verify all states from scratch
+            margins[:] = np.nan
+        elif tf_correlation is None:
+            raise ValueError('Incremental updates require dynamics with a '
+                             '`correlation` method.')
+        else:
+            new_data = np.atleast_2d(new_data)
+        tolerance = config.correlation_tolerance
 
         # reset the safe set
         safe_set = np.zeros_like(self.safe_set)
-        value_order = np.argsort(self.values)
+        values = self.get_values()
+        value_order = np.argsort(values)
 
         if self.initial_safe_set is not None:
             safe_set[self.initial_safe_set] = True
@@ -398,16 +908,49 @@ class Lyapunov(object):
             # Permute the initial safe set too
             safe_set = safe_set[value_order]
 
-        # Verify safety in batches
-        batch_generator = batchify((value_order, safe_set), batch_size)
+        # Verify safety in batches, grouped into rounds
+        if strategy == 'linear':
+            batch_generator = batchify((value_order, safe_set), batch_size)
+            rounds = _waves(batch_generator, num_workers)
+        else:
+            rounds = _galloping_rounds((value_order, safe_set), batch_size,
+                                       num_batches=max(num_workers, 1))
         index_to_state = self.discretization.index_to_state
-
-        for i, (indices, safe_batch) in batch_generator:
-
-            feed_dict[tf_states] = index_to_state(indices)
-
-            # Update the safety with the safe_batch result
-            safe_batch |= tf_negative.eval(feed_dict=feed_dict)
+        session = tf.get_default_session()
+
+        # States whose margins are consistent with the data of this call
+        verified = np.zeros(len(margins), dtype=np.bool)
+
+        def verify(batch):
+            """Update the safe_batch with the verification result."""
+            i, (indices, safe_batch) = batch
+            verified[indices] = True
+            # Separate feed_dict so that batches can run concurrently
+            batch_feed_dict = feed_dict.copy()
+
+            margin = margins[indices]
+            outdated = np.isnan(margin)
+
+            # Cached states that are affected by the new data
+            cached = ~outdated
+            if new_data is not None and np.any(cached):
+                batch_feed_dict[tf_states] = index_to_state(indices[cached])
+                batch_feed_dict[tf_new_data] = new_data
+                correlation = session.run(tf_correlation,
+                                          feed_dict=batch_feed_dict)
+                outdated[cached] = correlation > tolerance
+
+            if np.any(outdated):
+                batch_feed_dict[tf_states] = index_to_state(indices[outdated])
+                margin[outdated] = session.run(tf_margin,
+                                               feed_dict=batch_feed_dict)
+                margins[indices[outdated]] = margin[outdated]
+
+            safe_batch |= margin < 0
+            return i, safe_batch
+
+        for i, safe_batch in _map_rounds(verify, rounds,
+                                         num_workers=num_workers):
             # TODO: Make the discretization adaptive?
 
             # Boolean array: argmin returns first element that is False
@@ -416,14 +959,22 @@ class Lyapunov(object):
 
             # Check if there are unsafe elements in the batch
             if bound > 0 or not safe_batch[0]:
-                # Make sure all following points are labeled as unsafe
-                safe_batch[bound:] = False
+                # Make sure all following points are labeled as unsafe. This
+                # includes batches that were verified concurrently.
+                safe_set[i + bound:] = False
+                # The largest index of a safe value
+                max_index = i + bound - 1
                 break
+        else:
+            # All states are safe
+            max_index = len(safe_set) - 1
+
+        # The scan may stop early, before the new data was checked against
+        # all cached margins. Those margins are outdated.
+        margins[~verified] = np.nan
 
-        # The largest index of a safe value
-        max_index = i + bound - 1
         # Set placeholder for c_max to the corresponding value
-        feed_dict[self.c_max] = self.values[value_order[max_index]]
+        feed_dict[self.c_max] = values[value_order[max_index]]
 
         # Restore the order of the safe set
         safe_nodes = value_order[safe_set]
@@ -480,17 +1031,16 @@ def perturb_actions(states, actions, perturbations, limits=None):
     return state_actions
 
 
-_STORAGE = {}
-
-
 @with_scope('get_safe_sample')
 def get_safe_sample(lyapunov, perturbations=None, limits=None, positive=False,
-                    num_samples=None, actions=None):
+                    num_samples=None, actions=None, number=1):
     """Compute a safe state-action pair for sampling.
 
     This function returns the most uncertain state-action pair close to the
     current policy (as a result of the perturbations) that is safe (maps
-    back into the region of attraction).
+    back into the region of attraction). The state-action pairs are
+    evaluated in batches of at most `config.gp_batch_size` pairs, so that
+    they are never all held in memory at once.
 
     Parameters
     ----------
@@ -512,14 +1062,23 @@ def get_safe_sample(lyapunov, perturbations=None, limits=None, positive=False,
     actions : ndarray
         A list of actions to evaluate for each state. Ignored if perturbations
         is not None.
+    number : int, optional
+        The number of state-action pairs to return, for example to run
+        several experiments in parallel. If the dynamics are a
+        `GaussianProcess` or a `FunctionStack` thereof, the pairs are
+        selected greedily among the 10 * number most uncertain safe pairs,
+        each time conditioning the GP on the previously selected pairs.
+        Otherwise, the most uncertain safe pairs are returned.
 
     Returns
     -------
     state-action : ndarray
         A row-vector that contains a safe state-action pair that is
-        promising for obtaining future observations.
+        promising for obtaining future observations. One row for each pair
+        if number > 1.
     var : float
-        The uncertainty remaining at this state.
+        The uncertainty remaining at this state. An array with one entry for
+        each pair if number > 1.
     """
     state_disc = lyapunov.discretization
 
@@ -566,47 +1125,185 @@ def get_safe_sample(lyapunov, perturbations=None, limits=None, positive=False,
          mean, bound, maps_inside) = storage.values()
 
     # All the safe states within the discretization
-    safe_states = state_disc.index_to_state(np.where(lyapunov.safe_set))
+    safe_indices = np.where(lyapunov.safe_set)[0]
 
     # Subsample safe states
-    if num_samples is not None and len(safe_states) > num_samples:
-        idx = np.random.choice(len(safe_states), num_samples, replace=False)
-        safe_states = safe_states[idx]
+    if num_samples is not None and len(safe_indices) > num_samples:
+        safe_indices = np.random.choice(safe_indices, num_samples,
+                                        replace=False)
 
-    # Update the feed_dict accordingly
-    feed_dict = lyapunov.feed_dict
-    feed_dict[tf_safe_states] = safe_states
+    # Evaluate at most gp_batch_size state-action pairs at a time
+    num_actions = len(actions if perturbations is None else perturbations)
+    batch_size = max(config.gp_batch_size // num_actions, 1)
 
-    if perturbations is None:
-        # Generate all state-action pairs
-        arrays = [arr.ravel() for arr in np.meshgrid(safe_states,
-                                                     actions,
-                                                     indexing='ij')]
-        state_actions = np.column_stack(arrays)
+    session = tf.get_default_session()
+    feed_dict = lyapunov.feed_dict.copy()
+
+    # Candidates for the greedy selection of multiple pairs
+    dynamics = lyapunov.dynamics
+    functions = getattr(dynamics, 'functions', [dynamics])
+    greedy = number > 1 and all(isinstance(fun, GaussianProcess)
+                                for fun in functions)
+    pool_size = 10 * number if greedy else number
+
+    # The most uncertain safe state-action pairs, sorted by variance
+    pool_state_actions = np.empty((0, state_dim + action_dim),
+                                  dtype=config.np_dtype)
+    pool_var = np.empty(0, dtype=config.np_dtype)
+
+    for _, (indices,) in batchify(safe_indices, batch_size):
+        safe_states = state_disc.index_to_state(indices)
+
+        if perturbations is None:
+            # Generate all state-action pairs
+            state_actions = np.column_stack(
+                (np.repeat(safe_states, num_actions, axis=0),
+                 np.tile(actions, (len(safe_states), 1))))
+        else:
+            # Generate state-action pairs around the current policy
+            feed_dict[tf_safe_states] = safe_states
+            safe_actions = session.run(tf_actions, feed_dict=feed_dict)
+            state_actions = perturb_actions(safe_states,
+                                            safe_actions,
+                                            perturbations=perturbations,
+                                            limits=action_limits)
+
+        # Evaluate the safety of the proposed state-action pairs
+        feed_dict[tf_safe_states] = state_actions[:, :state_dim]
+        feed_dict[tf_state_actions] = state_actions
+        safe, next_states, var = session.run([maps_inside, mean, bound],
+                                             feed_dict=feed_dict)
+        safe = safe.squeeze(axis=1)
+
+        # Check whether states map back to the safe set in expectation
+        if not positive:
+            next_state_index = state_disc.state_to_index(next_states)
+            safe &= lyapunov.safe_set[next_state_index]
+
+        # Keep track of the safe state-action pairs with the largest variance
+        pool_state_actions = np.vstack((pool_state_actions,
+                                        state_actions[safe]))
+        pool_var = np.concatenate((pool_var, var[safe, 0]))
+
+        # Stable sort, so that ties are resolved in favor of earlier pairs
+        order = np.argsort(-pool_var, kind='mergesort')[:pool_size]
+        pool_state_actions = pool_state_actions[order]
+        pool_var = pool_var[order]
+
+    if not len(pool_var):
+        raise ValueError('There are no safe state-action pairs.')
+
+    if number == 1:
+        return pool_state_actions[[0]], pool_var[0]
+
+    if greedy:
+        covariances, noise_variances = _posterior_covariances(
+            lyapunov, pool_state_actions)
+        scaling = [fun.beta * fun.output_dim for fun in functions]
+        selected = _greedy_variance_selection(scaling, covariances,
+                                              noise_variances, number)
+    else:
+        selected = slice(None)
+
+    return pool_state_actions[selected], pool_var[selected]
+
+
+@with_scope('posterior_covariances')
+def _posterior_covariances(lyapunov, state_actions):
+    """Return the posterior covariances of GP dynamics.
+
+    Parameters
+    ----------
+    lyapunov : instance of `Lyapunov`
+        A Lyapunov instance whose dynamics are a `GaussianProcess` or a
+        `FunctionStack` of `GaussianProcess` instances.
+    state_actions : ndarray
+        The state-action pairs at which to evaluate the covariances.
+
+    Returns
+    -------
+    covariances : list of ndarray
+        The posterior covariance matrix between the state-action pairs for
+        each GP.
+    noise_variances : list of float
+        The measurement noise variance of each GP.
+    """
+    dynamics = lyapunov.dynamics
+    functions = getattr(dynamics, 'functions', [dynamics])
+
+    storage = get_storage(_STORAGE, index=lyapunov)
+
+    if storage is None:
+        tf_state_actions = tf.placeholder(config.dtype,
+                                          shape=[None, state_actions.shape[1]])
+
+        covariances = []
+        noise_variances = []
+        for fun in functions:
+            gp = fun.gaussian_process
+            with gp.tf_mode():
+                _, covariance = gp.build_predict(tf_state_actions,
+                                                 full_cov=True)
+                # The covariance is the same for all outputs of a GP
+                covariances.append(covariance[:, :, 0])
+                noise_variances.append(gp.likelihood.variance)
+
+        storage = [('tf_state_actions', tf_state_actions),
+                   ('covariances', covariances),
+                   ('noise_variances', noise_variances)]
+        set_storage(_STORAGE, storage, index=lyapunov)
     else:
-        # Generate state-action pairs around the current policy
-        safe_actions = tf_actions.eval(feed_dict=feed_dict)
-        state_actions = perturb_actions(safe_states,
-                                        safe_actions,
-                                        perturbations=perturbations,
-                                        limits=action_limits)
+        tf_state_actions, covariances, noise_variances = storage.values()
 
-    # Update feed value
-    lyapunov.feed_dict[tf_state_actions] = state_actions
+    feed_dict = lyapunov.feed_dict.copy()
+    feed_dict[tf_state_actions] = state_actions
 
-    # Evaluate the safety of the proposed state-action pairs
     session = tf.get_default_session()
-    maps_inside, mean, var = session.run([maps_inside, mean, bound],
-                                         feed_dict=lyapunov.feed_dict)
-    maps_inside = maps_inside.squeeze(axis=1)
-
-    # Check whether states map back to the safe set in expectation
-    if not positive:
-        next_state_index = lyapunov.discretization.state_to_index(mean)
-        safe_in_expectation = lyapunov.safe_set[next_state_index]
-        maps_inside &= safe_in_expectation
-
-    # Return only state-actions pairs that are safe
-    var_safe = var[maps_inside]
-    max_id = np.argmax(var_safe)
-    return state_actions[maps_inside, :][[max_id]], var_safe[max_id].squeeze()
+    covariances, noise_variances = session.run([covariances, noise_variances],
+                                               feed_dict=feed_dict)
+    return covariances, [np.squeeze(noise) for noise in noise_variances]
+
+
+def _greedy_variance_selection(scaling, covariances, noise_variances, number):
+    """Greedily select points that maximize the remaining uncertainty.
+
+    After each selection, the covariances are conditioned on a measurement
+    at the selected point. This does not require the measured value.
+
+    Parameters
+    ----------
+    scaling : list of float
+        The weight of the standard deviation of each GP in the uncertainty.
+    covariances : list of ndarray
+        The posterior covariance matrix of each GP between the points.
+    noise_variances : list of float
+        The measurement noise variance of each GP.
+    number : int
+        The number of points to select.
+
+    Returns
+    -------
+    selected : ndarray
+        The indices of the selected points, in the order of selection.
+    """
+    covariances = [covariance.copy() for covariance in covariances]
+    num_points = len(covariances[0])
+    number = min(number, num_points)
+
+    selected = np.empty(number, dtype=np.int)
+    available = np.ones(num_points, dtype=np.bool)
+
+    for i in range(number):
+        uncertainty = sum(weight * np.sqrt(np.maximum(np.diag(cov), 0))
+                          for weight, cov in zip(scaling, covariances))
+        uncertainty[~available] = -np.inf
+        selected[i] = np.argmax(uncertainty)
+        available[selected[i]] = False
+
+        # Condition each GP on a measurement at the selected point
+        for covariance, noise in zip(covariances, noise_variances):
+            column = covariance[:, selected[i]].copy()
+            covariance -= (np.outer(column, column)
+                           / (column[selected[i]] + noise))
+
+    return selected
@@ -6,13 +6,16 @@ from types import ModuleType
 
 import tensorflow as tf
 import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg as sparse_linalg
 try:
     import cvxpy
 except ImportError as exception:
     cvxpy = exception
 
+from .functions import GridWorld
 from .utilities import (make_tf_fun, with_scope, get_storage, set_storage,
-                        get_feed_dict)
+                        get_feed_dict, parameter_token)
 
 from safe_learning import config
 
@@ -55,12 +58,31 @@ class PolicyIteration(object):
         self.value_function = value_function
         self.gamma = gamma
 
-        state_space = self.value_function.discretization.all_points
-        self.state_space = tf.stack(state_space, name='state_space')
-
         self.policy = policy
         self.feed_dict = get_feed_dict(tf.get_default_graph())
         self._storage = {}
+        self._transition_cache = None
+        self._state_space = None
+
+    @property
+    def state_space(self):
+        """A tensor with all the states of the discretization.
+
+        The tensor is only added to the graph when it is first used.
+        Evaluating it builds all the states at once, which is what
+        `value_iteration`, `optimize_value_function` and gradients of the
+        future values require. `transition_operator` and
+        `run_value_iteration` evaluate the states of a `GridWorld` in batches
+        instead and never use this tensor.
+        """
+        if self._state_space is None:
+            discretization = self.value_function.discretization
+            if isinstance(discretization, GridWorld):
+                state_space = discretization.tf_all_points()
+            else:
+                state_space = discretization.all_points
+            self._state_space = tf.identity(state_space, name='state_space')
+        return self._state_space
 
     @with_scope('future_values')
     def future_values(self, states, policy=None, actions=None, lyapunov=None,
@@ -134,11 +156,149 @@ class PolicyIteration(object):
 
     @with_scope('value_iteration')
     def value_iteration(self):
-        """Perform one step of value iteration."""
+        """Perform one step of value iteration.
+
+        The future values are evaluated at all states in a single graph, see
+        `run_value_iteration` for an evaluation in batches.
+        """
         future_values = self.future_values(self.state_space)
         return tf.assign(self.value_function.parameters[0], future_values,
                          name='value_iteration_update')
 
+    def transition_operator(self):
+        """Return the transition matrix and rewards of the current policy.
+
+        The operator is computed once per policy and reused as long as the
+        parameters of the policy do not change. A policy without parameters is
+        treated as fixed. Changes of the dynamics, the reward function, or a
+        policy without parameters are not detected; call
+        `clear_transition_operator` in that case. The states of a `GridWorld`
+        are evaluated in batches of size `config.gp_batch_size`, so that only
+        one batch of states and next states is held in memory at a time.
+
+        Returns
+        -------
+        value_matrix : scipy.sparse.csr_matrix
+            A sparse matrix B so that B.dot(parameters) are the values of the
+            value function at the next states.
+        rewards : ndarray
+            The rewards at the states of the discretization.
+        """
+        parameters = getattr(self.policy, 'parameters', None)
+        token = parameter_token(parameters, feed_dict=self.feed_dict)
+
+        cache = self._transition_cache
+        if cache is not None and cache[0] == token:
+            return cache[1:]
+
+        storage = get_storage(self._storage)
+        discretization = self.value_function.discretization
+
+        if storage is None:
+            if isinstance(discretization, GridWorld):
+                state_dim = discretization.ndim
+            else:
+                state_dim = discretization.all_points.shape[1]
+            tf_states = tf.placeholder(config.dtype, shape=[None, state_dim],
+                                       name='states')
+            actions = self.policy(tf_states)
+            next_states = self.dynamics(tf_states, actions)
+            # Only use the mean dynamics
+            if isinstance(next_states, tuple):
+                next_states, var = next_states
+            rewards = self.reward_function(tf_states, actions)
+
+            storage = [('states', tf_states), ('next_states', next_states),
+                       ('rewards', rewards)]
+            set_storage(self._storage, storage)
+        else:
+            tf_states, next_states, rewards = storage.values()
+
+        if isinstance(discretization, GridWorld):
+            batches = discretization.point_batches()
+        else:
+            batches = [(0, discretization.all_points)]
+
+        session = tf.get_default_session()
+        feed_dict = self.feed_dict.copy()
+        value_matrices = []
+        batch_rewards = []
+        for _, points in batches:
+            feed_dict[tf_states] = points
+            batch_next_states, batch_reward = session.run(
+                [next_states, rewards], feed_dict=feed_dict)
+
+            value_matrix = self.value_function.tri.parameter_derivative(
+                batch_next_states)
+            value_matrices.append(sparse.csr_matrix(value_matrix))
+            batch_rewards.append(np.ravel(batch_reward))
+
+        value_matrix = sparse.vstack(value_matrices, format='csr')
+        rewards = np.concatenate(batch_rewards)
+
+        self._transition_cache = (token, value_matrix, rewards)
+        return value_matrix, rewards
+
+    def clear_transition_operator(self):
+        """Remove the cached transition operator of the policy."""
+        self._transition_cache = None
+
+    def run_value_iteration(self, max_iter=1000, tol=1e-6):
+        """Evaluate the current policy with repeated value iteration.
+
+        The dynamics, policy, and rewards are evaluated once, after which each
+        sweep of value iteration is a sparse matrix-vector product. The
+        operator is reused by later calls for the same policy, see
+        `transition_operator`. The iteration stops once the largest change of
+        the values is below `tol`.
+
+        Parameters
+        ----------
+        max_iter : int, optional
+            The maximum number of sweeps.
+        tol : float, optional
+            The tolerance on the sup-norm of the residual between two sweeps.
+
+        Returns
+        -------
+        num_iter : int
+            The number of sweeps that were performed.
+        residuals : ndarray
+            The sup-norm of the residual after every sweep.
+        """
+        value_matrix, rewards = self.transition_operator()
+
+        storage = get_storage(self._storage)
+        parameters = self.value_function.parameters[0]
+
+        if storage is None:
+            tf_values = tf.placeholder(config.dtype,
+                                       shape=parameters.get_shape(),
+                                       name='values')
+            assign_op = tf.assign(parameters, tf_values,
+                                  name='value_iteration_update')
+            storage = [('values', tf_values), ('assign_op', assign_op)]
+            set_storage(self._storage, storage)
+        else:
+            tf_values, assign_op = storage.values()
+
+        session = tf.get_default_session()
+        values = np.ravel(session.run(parameters))
+
+        residuals = []
+        for _ in range(max_iter):
+            new_values = rewards + self.gamma * value_matrix.dot(values)
+            residuals.append(np.max(np.abs(new_values - values)))
+            values = new_values
+            if residuals[-1] <= tol:
+                break
+
+        feed_dict = self.feed_dict.copy()
+        feed_dict[tf_values] = values[:, None]
+        session.run(assign_op, feed_dict=feed_dict)
+
+        return len(residuals), np.array(residuals)
+
     @make_tf_fun(tf.float64)
     def _run_cvx_optimization(self, next_states, rewards, **solver_options):
         """Tensorflow wrapper around a cvxpy value function optimization.
@@ -177,21 +337,80 @@ class PolicyIteration(object):
 
         return np.array(values.value)
 
+    @make_tf_fun(tf.float64)
+    def _run_sparse_optimization(self, next_states, rewards, values,
+                                 method='spsolve', **solver_options):
+        """Tensorflow wrapper around a sparse value function optimization.
+
+        The constraints of the linear program in `_run_cvx_optimization` are
+        tight at the optimum, so that the values are the solution of the
+        sparse linear system (I - gamma * B) v = r.
+
+        Parameters
+        ----------
+        next_states : ndarray
+        rewards : ndarray
+        values : ndarray
+            The current values, used as initial guess by iterative solvers.
+        method : {'spsolve', 'gmres', 'bicgstab'}
+            The scipy.sparse.linalg solver.
+
+        Returns
+        -------
+        values : ndarray
+            The optimal values at the states.
+        """
+        value_matrix = self.value_function.tri.parameter_derivative(
+            next_states)
+        value_matrix = sparse.csr_matrix(value_matrix)
+        matrix = (sparse.eye(value_matrix.shape[0], format='csr')
+                  - self.gamma * value_matrix)
+        rewards = np.ravel(rewards)
+
+        if method == 'spsolve':
+            values = sparse_linalg.spsolve(matrix.tocsc(), rewards,
+                                           **solver_options)
+        else:
+            iterative_solvers = {'gmres': sparse_linalg.gmres,
+                                 'bicgstab': sparse_linalg.bicgstab}
+            values, info = iterative_solvers[method](matrix, rewards,
+                                                     x0=np.ravel(values),
+                                                     **solver_options)
+            if info != 0:
+                raise OptimizationError('The {} solver did not converge: {}'
+                                        .format(method, info))
+
+        return values[:, None].astype(config.np_dtype)
+
     @with_scope('optimize_value_function')
-    def optimize_value_function(self, **solver_options):
-        """Optimize the value function using cvx.
+    def optimize_value_function(self, method='cvxpy', **solver_options):
+        """Optimize the value function using cvx or sparse linear algebra.
+
+        The dynamics and rewards are evaluated at all states in a single
+        graph, so that the returned operation can be rerun after the policy
+        changed. Use `run_value_iteration` to evaluate the states of large
+        discretizations in batches.
 
         Parameters
         ----------
+        method : {'cvxpy', 'spsolve', 'gmres', 'bicgstab'}, optional
+            Either solve the linear program with cvxpy, or the equivalent
+            sparse linear system with the corresponding scipy.sparse.linalg
+            solver. The latter scales to much larger discretizations. The
+            iterative solvers 'gmres' and 'bicgstab' start from the current
+            values of the value function.
         solver_options : kwargs, optional
-            Additional solver options passes to cvxpy.Problem.solve.
+            Additional solver options passes to cvxpy.Problem.solve (e.g.,
+            `solver=cvxpy.SCS`) or to the scipy solver.
 
         Returns
         -------
         assign_op : tf.Tensor
             An assign operation that updates the value function.
         """
-        if not isinstance(cvxpy, ModuleType):
+        if method not in ('cvxpy', 'spsolve', 'gmres', 'bicgstab'):
+            raise ValueError('Unknown method: {}'.format(method))
+        if method == 'cvxpy' and not isinstance(cvxpy, ModuleType):
             raise cvxpy
 
         actions = self.policy(self.state_space)
@@ -204,9 +423,14 @@ class PolicyIteration(object):
         rewards = self.reward_function(self.state_space,
                                        actions)
 
-        values = self._run_cvx_optimization(next_states,
-                                            rewards,
-                                            **solver_options)
+        if method == 'cvxpy':
+            values = self._run_cvx_optimization(next_states,
+                                                rewards,
+                                                **solver_options)
+        else:
+            values = self._run_sparse_optimization(
+                next_states, rewards, self.value_function.parameters[0],
+                method=method, **solver_options)
 
         return tf.assign(self.value_function.parameters[0], values)
 
@@ -214,66 +438,94 @@ class PolicyIteration(object):
     def discrete_policy_optimization(self, action_space, constraint=None):
         """Optimize the policy for a given value function.
 
+        All combinations of states and actions are evaluated in a single
+        graph, which also selects the best action for each state. The states
+        are processed in chunks, such that each chunk contains at most
+        `config.gp_batch_size` state-action pairs.
+
         Parameters
         ----------
         action_space : ndarray
             The parameter value to evaluate (for each parameter). This is
             geared towards piecewise linear functions.
         constraint : callable
-            A function that can be called with a policy. Returns the slack of
-            the safety constraint for each state. A policy is safe if the slack
-            is >=0 for all constraints.
+            A function that can be called with states and actions, one
+            state-action pair on each row. Returns the slack of the safety
+            constraint for each pair. An action is safe if the slack is >=0.
+            It is called once for each chunk of states, with all actions.
         """
-        states = self.policy.discretization.all_points
-        n_states = states.shape[0]
+        discretization = self.policy.discretization
+        n_states = discretization.nindex
         n_options, n_actions = action_space.shape
 
-        # Initialize
-        values = np.empty((n_states, n_options), dtype=config.np_dtype)
-        action_array = np.broadcast_to(np.zeros(n_actions,
-                                                dtype=config.np_dtype),
-                                       (n_states, n_actions))
-
         # Create tensorflow operations, but reuse previous graph elements
         storage = get_storage(self._storage)
 
         if storage is None:
-            # Computation of future values
+            states = tf.placeholder(config.dtype,
+                                    shape=[None, discretization.ndim],
+                                    name='states')
             actions = tf.placeholder(config.dtype,
-                                     shape=action_array.shape,
-                                     name='actions')
-            future_values = self.future_values(states,
-                                               actions=actions)
+                                     shape=[None, n_actions],
+                                     name='action_space')
+            safe = tf.placeholder(tf.bool, shape=[None, None], name='safe')
+
+            # All state-action pairs, with the actions varying fastest
+            num_states = tf.shape(states)[0]
+            num_options = tf.shape(actions)[0]
+            tiled_states = tf.reshape(tf.tile(states, [1, num_options]),
+                                      [-1, discretization.ndim])
+            tiled_actions = tf.tile(actions, [num_states, 1])
+            future_values = self.future_values(tiled_states,
+                                               actions=tiled_actions)
+
+            # Select the best safe action for each state
+            future_values = tf.reshape(future_values,
+                                       tf.stack((num_states, num_options)))
+            unsafe_values = tf.fill(tf.shape(future_values),
+                                    tf.constant(-np.inf, dtype=config.dtype))
+            future_values = tf.where(safe, future_values, unsafe_values)
+            best_options = tf.argmax(future_values, axis=1)
 
             # Assigning new parameters
-            parameters = tf.placeholder(config.dtype, action_array.shape)
+            parameters = tf.placeholder(config.dtype, [n_states, n_actions])
             assign_op = tf.assign(self.policy.parameters[0], parameters)
 
             # Put things into storage
-            storage = [('actions', actions),
-                       ('future_values', future_values),
+            storage = [('states', states),
+                       ('actions', actions),
+                       ('safe', safe),
+                       ('best_options', best_options),
                        ('parameters', parameters),
                        ('assign_op', assign_op)]
             set_storage(self._storage, storage)
         else:
             # Get items out of storage
-            actions, future_values, parameters, assign_op = storage.values()
-
-        feed_dict = self.feed_dict
-        feed_dict[actions] = action_array
-
-        # Compute values for each action
-        for i, action in enumerate(action_space):
-            # Update feed dict
-            action_array.base[:] = action
-            # Compute values
-            values[:, i] = future_values.eval(feed_dict=feed_dict)[:, 0]
-
-            if constraint is not None:
+            (states, actions, safe, best_options,
+             parameters, assign_op) = storage.values()
+
+        feed_dict = self.feed_dict.copy()
+        feed_dict[actions] = action_space
+
+        # Compute the best action for each chunk of states
+        best = np.empty(n_states, dtype=np.int)
+        batch_size = max(config.gp_batch_size // n_options, 1)
+        for i, batch in discretization.point_batches(batch_size):
+            # Evaluate the constraint for all actions of the chunk
+            if constraint is None:
+                is_safe = np.ones((len(batch), n_options), dtype=np.bool)
+            else:
                 # TODO: optimize safety if unsafe
-                unsafe = constraint(action_array) < 0
-                values[unsafe, i] = -np.inf
+                tiled_states = np.repeat(batch, n_options, axis=0)
+                tiled_actions = np.tile(action_space, (len(batch), 1))
+                slack = constraint(tiled_states, tiled_actions)
+                is_safe = np.reshape(np.ravel(slack) >= 0,
+                                     (len(batch), n_options))
+
+            feed_dict[states] = batch
+            feed_dict[safe] = is_safe
+            best[i:i + len(batch)] = best_options.eval(feed_dict=feed_dict)
 
         # Select best action for policy
-        best_actions = action_space[np.argmax(values, axis=1)]
+        best_actions = action_space[best]
         assign_op.eval({parameters: best_actions})
@@ -5,6 +5,7 @@ from __future__ import division, print_function, absolute_import
 from numpy.testing import assert_equal, assert_allclose
 import pytest
 import numpy as np
+from scipy import sparse
 from scipy.optimize import check_grad
 import tensorflow as tf
 
@@ -12,8 +13,10 @@ from safe_learning.functions import (_Triangulation, Triangulation,
                                      ScipyDelaunay, GridWorld,
                                      PiecewiseConstant, DeterministicFunction,
                                      UncertainFunction, QuadraticFunction,
-                                     DimensionError, GPRCached,
-                                     GaussianProcess, NeuralNetwork)
+                                     DimensionError, GPRCached, SGPRCached,
+                                     KroneckerGPR,
+                                     GaussianProcess, NeuralNetwork,
+                                     FunctionStack, sample_gp_function)
 from safe_learning.utilities import concatenate_inputs
 
 try:
@@ -55,6 +58,25 @@ class TestFunction(object):
             output2 = a(input)
             assert_allclose(2. * input, output2.eval())
 
+    def test_evaluate(self, testing_class):
+        """Test the evaluation of numpy arrays."""
+        A, sess = testing_class
+        with sess.as_default():
+            a = A(2.)
+            points = np.array([[1.], [2.]])
+            assert_allclose(a.evaluate(points), 2. * points)
+
+            # The graph is reused for new batch sizes
+            num_ops = len(sess.graph.get_operations())
+            points = np.arange(3.)[:, None]
+            assert_allclose(a.evaluate(points), 2. * points)
+            assert len(sess.graph.get_operations()) == num_ops
+
+            # New input dimensions require a new graph
+            points = np.ones((3, 2))
+            assert_allclose(a.evaluate(points), 2. * points)
+            assert len(a._evaluators) == 2
+
     def test_add(self, testing_class):
         """Test adding functions."""
         A, sess = testing_class
@@ -188,6 +210,86 @@ class TestGPRCached(object):
         assert_allclose(m1, m2)
         assert_allclose(v1, v2)
 
+    def test_incremental_cache(self):
+        """Test that the extended cache matches a full recomputation."""
+        x = np.array([[1, 0], [0, 1]], dtype=float)
+        y = np.array([[0], [1]], dtype=float)
+        x_new = np.array([[0.5, 0.5], [1.2, 2.3], [3., 2.]])
+        y_new = np.array([[0.3], [2.4], [-1.]])
+
+        gp = GPRCached(x, y, gpflow.kernels.RBF(2))
+        gp.X = np.vstack((x, x_new[:1]))
+        gp.Y = np.vstack((y, y_new[:1]))
+        gp.update_cache()
+        gp.X = np.vstack((x, x_new))
+        gp.Y = np.vstack((y, y_new))
+        gp.update_cache()
+
+        gp_full = GPRCached(gp.X.value, gp.Y.value, gpflow.kernels.RBF(2))
+        assert_allclose(gp.cholesky.value, gp_full.cholesky.value)
+        assert_allclose(gp.alpha.value, gp_full.alpha.value)
+
+        # Changing the hyperparameters forces a full update
+        gp.kern.lengthscales = 2.
+        gp.update_cache()
+        gp_full.kern.lengthscales = 2.
+        gp_full.update_cache(full=True)
+        assert_allclose(gp.cholesky.value, gp_full.cholesky.value)
+
+    def test_refactorization_interval(self):
+        """Test that only extensions count towards a refactorization."""
+        x = np.array([[1, 0], [0, 1]], dtype=float)
+        y = np.array([[0], [1]], dtype=float)
+
+        gp = GPRCached(x, y, gpflow.kernels.RBF(2),
+                       refactorization_interval=2)
+
+        # Updates without new data leave the cache untouched
+        for _ in range(3):
+            gp.update_cache()
+        assert gp._num_updates == 0
+
+        gp.X = np.vstack((x, [[0.5, 0.5]]))
+        gp.Y = np.vstack((y, [[0.3]]))
+        gp.update_cache()
+        assert gp._num_updates == 1
+
+        # The second extension refactorizes
+        gp.X = np.vstack((gp.X.value, [[1.2, 2.3]]))
+        gp.Y = np.vstack((gp.Y.value, [[2.4]]))
+        gp.update_cache()
+        assert gp._num_updates == 0
+
+    def test_correlation(self):
+        """Test the posterior correlation for the different models."""
+        discretization = GridWorld([[-1, 1], [0, 2]], [4, 3])
+        x = discretization.all_points
+        y = np.sin(x[:, :1]) + x[:, 1:]
+        points = np.array([[0.9, 0.1], [3., 2], [0.3, 0.7]])
+        data = x[[1, 5]]
+
+        noise_variance = 0.01
+
+        gp = gpflow.gpr.GPR(x, y, gpflow.kernels.RBF(2))
+        gp.likelihood.variance = noise_variance
+        covariance = gp.predict_f_full_cov(np.vstack((points, data)))[1]
+        expected = np.max(np.abs(covariance[:3, 3:, 0]), axis=1)
+        expected /= noise_variance
+
+        models = [gpflow.gpr.GPR(x, y, gpflow.kernels.RBF(2)),
+                  GPRCached(x, y, gpflow.kernels.RBF(2)),
+                  KroneckerGPR(x, y, gpflow.kernels.RBF(2)),
+                  SGPRCached(x, y, gpflow.kernels.RBF(2), x)]
+        with tf.Session() as sess:
+            for model in models:
+                model.likelihood.variance = noise_variance
+                if hasattr(model, 'update_cache'):
+                    model.update_cache()
+                fun = GaussianProcess(model)
+                correlation = sess.run(fun.correlation(points, data),
+                                       feed_dict=fun.feed_dict)
+                assert_allclose(correlation, expected, rtol=1e-3, atol=1e-2)
+
     def test_predict_f(self, gps):
         """Make sure predictions is same as in uncached case."""
         # Note that this messes things up terribly due to caching. So this
@@ -200,6 +302,170 @@ class TestGPRCached(object):
         assert_allclose(b1, b2)
 
 
+@pytest.mark.skipif(gpflow is None, reason='gpflow module not installed')
+class TestSGPRCached(object):
+    """Test the SGPRCached class."""
+
+    def test_predict_f(self):
+        """Make sure predictions are the same as for gpflow and new data."""
+        x = np.array([[1, 0], [0, 1], [0.5, 0.5]], dtype=float)
+        y = np.array([[0], [1], [0.3]], dtype=float)
+        z = np.array([[1, 0], [0, 1]], dtype=float)
+        test_points = np.array([[0.9, 0.1], [3., 2]])
+
+        gp = gpflow.sgpr.SGPR(x, y, gpflow.kernels.RBF(2), z)
+        gp_cached = SGPRCached(x[:2], y[:2], gpflow.kernels.RBF(2), z)
+        assert gp_cached.num_inducing == 2
+
+        gpfun_cached = GaussianProcess(gp_cached)
+        gpfun_cached.add_data_point(x[2:], y[2:])
+
+        for expected, result in zip(gp.predict_f(test_points),
+                                    gp_cached.predict_f(test_points)):
+            assert_allclose(result, expected)
+
+        # Full update
+        gp_cached.update_cache(full=True)
+        assert_allclose(gp.predict_f(test_points)[0],
+                        gp_cached.predict_f(test_points)[0])
+
+
+@pytest.mark.skipif(gpflow is None, reason='gpflow module not installed')
+class TestKroneckerGPR(object):
+    """Test the KroneckerGPR class."""
+
+    def test_predict_f(self):
+        """Make sure predictions are the same as for gpflow."""
+        discretization = GridWorld([[-1, 1], [0, 2]], [4, 3])
+        random_state = np.random.RandomState(0)
+        permutation = random_state.permutation(discretization.nindex)
+        x = discretization.all_points[permutation]
+        y = np.sin(x[:, :1]) + x[:, 1:]
+        test_points = np.array([[0.9, 0.1], [3., 2]])
+
+        kernels = [gpflow.kernels.RBF(2, lengthscales=[0.5, 1.],
+                                      ARD=True)
+                   for _ in range(2)]
+        gp = gpflow.gpr.GPR(x, y, kernels[0])
+        gp_kron = KroneckerGPR(x, y, kernels[1])
+
+        for expected, result in zip(gp.predict_f(test_points),
+                                    gp_kron.predict_f(test_points)):
+            assert_allclose(result, expected)
+        for expected, result in zip(gp.predict_f_full_cov(test_points),
+                                    gp_kron.predict_f_full_cov(test_points)):
+            assert_allclose(result, expected)
+        assert_allclose(gp_kron.compute_log_likelihood(),
+                        gp.compute_log_likelihood())
+
+        # Samples interpolate the data for small noise
+        gp_kron.likelihood.variance = 1e-6
+        samples = gp_kron.sample_f(3)
+        assert samples.shape == (len(x), 3)
+        assert_allclose(samples, np.tile(y, (1, 3)), atol=1e-2)
+
+        # Only kernels that factorize over the dimensions are supported
+        for kernel in (gpflow.kernels.Matern32(2),
+                       gpflow.kernels.RBF(2) + gpflow.kernels.RBF(2)):
+            with pytest.raises(ValueError):
+                KroneckerGPR(x, y, kernel)
+
+    def test_dense_fallback(self):
+        """Test the predictions for data inputs that are not on a grid."""
+        discretization = GridWorld([[-1, 1], [0, 2]], [4, 3])
+        x = discretization.all_points
+        y = np.sin(x[:, :1]) + x[:, 1:]
+        x_new = np.array([[0.1, 0.3]])
+        y_new = np.array([[0.5]])
+        test_points = np.array([[0.9, 0.1], [3., 2]])
+
+        gp = KroneckerGPR(x, y, gpflow.kernels.RBF(2))
+        fun = GaussianProcess(gp)
+        with tf.Session():
+            fun.add_data_point(x_new, y_new)
+            assert gp.use_dense.value
+
+            gp_full = gpflow.gpr.GPR(gp.X.value, gp.Y.value,
+                                     gpflow.kernels.RBF(2))
+            for expected, result in zip(gp_full.predict_f(test_points),
+                                        gp.predict_f(test_points)):
+                assert_allclose(result, expected)
+            assert_allclose(gp.compute_log_likelihood(),
+                            gp_full.compute_log_likelihood())
+            with pytest.raises(ValueError):
+                gp.sample_f()
+
+            # Back on the grid, the Kronecker structure is used again
+            gp.X = x
+            gp.Y = y
+            gp.update_cache()
+            assert not gp.use_dense.value
+            gp_grid = gpflow.gpr.GPR(x, y, gpflow.kernels.RBF(2))
+            assert_allclose(gp.predict_f(test_points)[0],
+                            gp_grid.predict_f(test_points)[0])
+
+
+@pytest.mark.skipif(gpflow is None, reason='gpflow module not installed')
+class TestFunctionStack(object):
+    """Test the FunctionStack class."""
+
+    def test_shared_kernel(self):
+        """Test that the shared kernel mode agrees with separate GPs."""
+        x = np.array([[1, 0], [0, 1]], dtype=float)
+        y = np.array([[0, 1], [1, -1]], dtype=float)
+        x_new = np.array([[1.2, 2.3], [0.5, 0.5]])
+        y_new = np.array([[2.4, 0.], [0.3, 1.]])
+        test_points = np.array([[0.9, 0.1], [3., 2]])
+
+        stacks = []
+        for shared_kernel in (False, True):
+            gps = [GaussianProcess(GPRCached(x, y[:, [i]],
+                                             gpflow.kernels.RBF(2)),
+                                   beta=i + 1.)
+                   for i in range(2)]
+            stack = FunctionStack(gps, shared_kernel=shared_kernel)
+            stack.add_data_point(x_new, y_new)
+            stacks.append(stack)
+
+        with tf.Session() as sess:
+            separate, shared = [sess.run(stack(test_points),
+                                         feed_dict=stack.feed_dict)
+                                for stack in stacks]
+
+        assert_allclose(shared[0], separate[0])
+        assert_allclose(shared[1], separate[1])
+
+        # The other models keep consistent cache bookkeeping
+        first, second = [fun.gaussian_process for fun in stacks[1].functions]
+        assert second.num_updates == first.num_updates
+        assert_allclose(second.alpha.value,
+                        GPRCached(second.X.value, second.Y.value,
+                                  gpflow.kernels.RBF(2)).alpha.value)
+
+        # Hyperparameters must agree, also when adding data
+        for kernels, noise in (([gpflow.kernels.RBF(2),
+                                 gpflow.kernels.RBF(2, lengthscales=2.)], 1.),
+                               ([gpflow.kernels.RBF(2),
+                                 gpflow.kernels.RBF(2)], 0.1)):
+            gps = [GPRCached(x, y[:, [i]], kernel)
+                   for i, kernel in enumerate(kernels)]
+            gps[1].likelihood.variance = noise
+            funs = [GaussianProcess(gp) for gp in gps]
+            with pytest.raises(ValueError):
+                FunctionStack(funs, shared_kernel=True)
+
+        stack = stacks[1]
+        stack.functions[1].gaussian_process.kern.variance = 2.
+        with pytest.raises(ValueError):
+            stack.add_data_point(x_new, y_new)
+
+        gps = [GaussianProcess(GPRCached(x[i:i + 1], y[i:i + 1, :1],
+                                         gpflow.kernels.RBF(2)))
+               for i in range(2)]
+        with pytest.raises(ValueError):
+            FunctionStack(gps, shared_kernel=True)
+
+
 @pytest.mark.skipIf(gpflow is None, 'gpflow module not installed')
 class Testgpflow(object):
     """Test the GaussianProcess function class."""
@@ -261,6 +527,29 @@ class Testgpflow(object):
         assert_allclose(a1, a1_true)
         assert_allclose(b1, b1_true)
 
+    def test_sample_fourier(self, setup):
+        """Test that Fourier samples are conditioned on the data."""
+        sess, _ = setup
+        x = np.array([[1, 0], [0, 1]], dtype=float)
+        y = np.array([[0], [1]], dtype=float)
+        gp = gpflow.gpr.GPR(x, y, gpflow.kernels.Matern32(2))
+        gp.likelihood.variance = 1e-6
+        gpfun = GaussianProcess(gp)
+
+        discretization = GridWorld([[0, 1], [0, 1]], 2)
+        samples = sample_gp_function(discretization, gpfun, number=3,
+                                     return_function=False, method='fourier')
+        assert samples.shape == (3, 4)
+        # The grid points [1, 0] and [0, 1] are data points
+        assert_allclose(samples[:, [2, 1]], np.tile(y.T, (3, 1)), atol=1e-2)
+
+        fun = sample_gp_function(discretization, gpfun, method='fourier')[0]
+        values = sess.run(fun(x, noise=False), feed_dict=fun.feed_dict)
+        assert_allclose(values, y, atol=1e-2)
+
+        pytest.raises(ValueError, sample_gp_function, discretization, gpfun,
+                      method='unknown')
+
 
 class TestQuadraticFunction(object):
     """Test the quadratic function."""
@@ -350,6 +639,42 @@ class TestGridworld(object):
         index = grid.state_to_index(test_point)
         assert_equal(index, 0)
 
+    def test_point_batches(self):
+        """Test the batched and the tensorflow points."""
+        grid = GridWorld([[-1.1, 1.5], [2.2, 2.4]], [7, 8])
+
+        batches = list(grid.point_batches(batch_size=5))
+        assert_equal([i for i, _ in batches], np.arange(0, grid.nindex, 5))
+        assert len(batches[-1][1]) == grid.nindex % 5
+
+        points = np.vstack([batch for _, batch in batches])
+        assert_allclose(points, grid.all_points)
+
+        with tf.Session():
+            assert_equal(grid.tf_all_points().eval(), grid.all_points)
+
+    def test_neighbors(self):
+        """Test the neighbor lookup and the boundary indices."""
+        grid = GridWorld([[0, 1], [0, 1]], [3, 4])
+        assert_equal(grid.strides, [4, 1])
+        assert len(grid.neighbor_offsets) == 8
+        # The offsets are only computed once
+        assert grid.neighbor_offsets is grid.neighbor_offsets
+        assert grid.neighbor_strides is grid.neighbor_strides
+
+        # Only the central nodes are not on the boundary
+        assert_equal(grid.boundary_indices,
+                     np.setdiff1d(np.arange(grid.nindex), [5, 6]))
+
+        neighbors = grid.neighbors([5, 0])
+        assert_equal(neighbors[0], 5 + grid.neighbor_strides)
+        assert_equal(np.sort(neighbors[1][neighbors[1] >= 0]), [1, 4, 5])
+
+        # Neighbors are one grid step away along each dimension
+        states = grid.index_to_state(neighbors[0])
+        assert_allclose(states - grid.index_to_state(5),
+                        grid.neighbor_offsets * grid.unit_maxes)
+
     def test_integer_numpoints(self):
         """Check integer numpoints argument."""
         grid = GridWorld([[1, 2], [3, 4]], 2)
@@ -580,6 +905,74 @@ class TestTriangulationNumpy(object):
         result = delaunay(test_points)
         assert_allclose(result, true_values[:, None], atol=1e-5)
 
+    def test_derivative_cache(self):
+        """Test the LRU cache for the parameter derivative."""
+        discretization = GridWorld([[0, 1], [0, 1]], [3, 3])
+        delaunay = _Triangulation(discretization, cache_size=10 ** 6)
+
+        points1 = discretization.sample_continuous(10)
+        points2 = discretization.sample_continuous(10)
+
+        matrix = delaunay.parameter_derivative(points1)
+        assert delaunay.parameter_derivative(points1) is matrix
+        assert sparse.isspmatrix_csr(matrix)
+        assert_allclose(matrix.toarray(),
+                        delaunay._parameter_derivative(points1).toarray())
+        delaunay.parameter_derivative(points2)
+        assert (delaunay.cache_hits, delaunay.cache_misses) == (1, 2)
+
+        # Only room for one matrix, the least recently used one is evicted
+        delaunay.clear_cache()
+        delaunay.cache_size = (matrix.data.nbytes + matrix.indices.nbytes
+                               + matrix.indptr.nbytes)
+        delaunay.parameter_derivative(points1)
+        delaunay.parameter_derivative(points2)
+        assert delaunay.parameter_derivative(points1) is not matrix
+        assert delaunay.cache_misses == 5
+
+        # The format does not depend on the cache
+        delaunay.cache_size = 0
+        uncached = delaunay.parameter_derivative(points1)
+        assert sparse.isspmatrix_csr(uncached)
+        assert_allclose(uncached.toarray(), matrix.toarray())
+        assert delaunay.cache_misses == 5
+
+        # The cache can be enabled on the tensorflow wrapper
+        with tf.Graph().as_default():
+            tri = Triangulation(discretization,
+                                np.zeros(discretization.nindex),
+                                cache_size=10 ** 6)
+        assert tri.tri.cache_size == 10 ** 6
+
+    def test_kuhn(self):
+        """Test the closed-form triangulation along the diagonal."""
+        pytest.raises(ValueError, _Triangulation, GridWorld([[0, 1]], 2),
+                      method='none')
+
+        for ndim in (1, 2, 3, 4):
+            limits = [[-1, 1.5]] * ndim
+            discretization = GridWorld(limits, [3, 4, 5, 3][:ndim])
+            kuhn = _Triangulation(discretization, method='kuhn')
+            assert_equal(kuhn.triangulation.nsimplex, np.math.factorial(ndim))
+
+            # Linear functions are interpolated exactly
+            slope = np.arange(1., ndim + 1)
+            kuhn.parameters = discretization.all_points.dot(slope)
+
+            points = discretization.sample_continuous(100)
+            assert_allclose(kuhn(points)[:, 0], points.dot(slope))
+
+            # Points lie in the simplices
+            weights, _ = kuhn._get_weights(points)
+            assert np.all(weights > -1e-10)
+
+            # Points outside of the unit hyperrectangle
+            unit_points = np.random.rand(100, ndim) * discretization.unit_maxes
+            simplices = kuhn.triangulation.find_simplex(unit_points)
+            assert np.all(simplices >= 0)
+            simplices = kuhn.triangulation.find_simplex(-unit_points - 0.1)
+            assert np.all(simplices == -1)
+
     def test_gradient(self):
         """Test the gradient_at function."""
         discretization = GridWorld([[0, 1], [0, 1]], [2, 2])
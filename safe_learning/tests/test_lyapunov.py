@@ -9,14 +9,23 @@ import numpy as np
 import tensorflow as tf
 import sys
 
-from safe_learning.functions import (LinearSystem, GridWorld)
-from safe_learning.lyapunov import (Lyapunov, smallest_boundary_value)
+from safe_learning import config
+from safe_learning.functions import (LinearSystem, GridWorld, GPRCached,
+                                     GaussianProcess)
+from safe_learning.lyapunov import (Lyapunov, smallest_boundary_value,
+                                    get_lyapunov_region, get_safe_sample,
+                                    _greedy_variance_selection, _map_rounds)
 
 if sys.version_info.major <= 2:
     import mock
 else:
     from unittest import mock
 
+try:
+    import gpflow
+except ImportError:
+    gpflow = None
+
 
 class TestLyapunov(object):
     """Test the Lyapunov base class."""
@@ -73,6 +82,253 @@ class TestLyapunov(object):
             lyap.update_safe_set()
             assert_equal(lyap.safe_set, np.ones(3, dtype=np.bool))
 
+    @pytest.fixture
+    def expanding_lyapunov(self):
+        """Lyapunov instance that is safe for |x| < 0.675 only."""
+        with tf.Session(graph=tf.Graph()):
+            discretization = GridWorld([[-1, 1]], 41)
+            lyap_fun = lambda x: tf.reduce_sum(tf.square(x),
+                                               axis=1,
+                                               keep_dims=True)
+            # Stabilizing close to the origin, destabilizing outside
+            policy = lambda x: tf.where(tf.abs(x) < 0.675, -0.1 * x, 0.1 * x)
+
+            dynamics = LinearSystem(np.array([[1, 1.]]))
+            states = discretization.all_points
+            initial_set = np.where(np.abs(states[:, 0]) < 0.225)[0]
+
+            lyap = Lyapunov(discretization, lyap_fun, dynamics, 0.4, 0.3,
+                            0.005, policy, initial_set=initial_set)
+            yield lyap
+
+    def test_update_values(self, expanding_lyapunov):
+        """Test that values are evaluated in batches."""
+        lyap = expanding_lyapunov
+        states = lyap.discretization.all_points
+
+        values = lyap.values
+        with mock.patch.object(config, 'gp_batch_size', 4):
+            lyap.update_values()
+            num_ops = len(tf.get_default_graph().get_operations())
+            lyap.update_values()
+
+        # The graph and the value buffer are reused
+        assert len(tf.get_default_graph().get_operations()) == num_ops
+        assert lyap.values is values
+        assert_allclose(lyap.values, np.sum(states ** 2, axis=1))
+
+    def test_get_values(self, tmpdir):
+        """Test that values are only updated when the parameters change."""
+        with tf.Session(graph=tf.Graph()) as sess:
+            discretization = GridWorld([[-1, 1]], 5)
+            scaling = tf.Variable(1., dtype=config.dtype)
+            lyap_fun = lambda x: scaling * tf.reduce_sum(tf.square(x),
+                                                         axis=1)
+            lyap_fun.parameters = [scaling]
+            sess.run(tf.global_variables_initializer())
+
+            values_file = str(tmpdir.join('values.dat'))
+            lyap = Lyapunov(discretization, lyap_fun, None, 1., 1., 0.,
+                            None, values_file=values_file)
+            states = discretization.all_points[:, 0]
+
+            assert isinstance(lyap.values, np.memmap)
+            assert lyap.values_version == 1
+            assert lyap.get_values() is lyap.values
+            assert lyap.values_version == 1
+            assert_allclose(lyap.values, states ** 2)
+
+            # Changes of the parameters are only detected on request
+            sess.run(scaling.assign(2.))
+            assert_allclose(lyap.get_values(), states ** 2)
+            assert_allclose(lyap.get_values(check_parameters=True),
+                            2 * states ** 2)
+            assert lyap.values_version == 2
+            assert lyap.get_values(check_parameters=True) is lyap.values
+            assert lyap.values_version == 2
+
+            sess.run(scaling.assign(3.))
+            lyap.invalidate_values()
+            assert_allclose(lyap.get_values(), 3 * states ** 2)
+            assert lyap.values_version == 3
+
+            region = get_lyapunov_region(lyap, discretization, (2,))
+            assert_equal(region, [False, True, True, True, False])
+
+    def test_parallel_update(self, expanding_lyapunov):
+        """Test that concurrent verification gives the same safe set."""
+        lyap = expanding_lyapunov
+        true_safe_set = np.abs(lyap.discretization.all_points[:, 0]) < 0.675
+
+        with mock.patch.object(config, 'gp_batch_size', 4):
+            lyap.update_safe_set(num_workers=1)
+            safe_set = lyap.safe_set.copy()
+            c_max = lyap.feed_dict[lyap.c_max]
+
+            lyap.update_safe_set(num_workers=3)
+
+        assert_equal(safe_set, true_safe_set)
+        assert_equal(lyap.safe_set, safe_set)
+        assert_allclose(lyap.feed_dict[lyap.c_max], c_max)
+        assert_allclose(c_max, 0.65 ** 2)
+
+    def test_galloping_update(self, expanding_lyapunov):
+        """Test that the galloping strategy agrees with the linear scan."""
+        lyap = expanding_lyapunov
+
+        with mock.patch.object(config, 'gp_batch_size', 3):
+            lyap.update_safe_set(strategy='linear')
+            safe_set = lyap.safe_set.copy()
+            c_max = lyap.feed_dict[lyap.c_max]
+
+            for num_workers in (1, 3):
+                lyap.update_safe_set(num_workers=num_workers,
+                                     strategy='galloping')
+                assert_equal(lyap.safe_set, safe_set)
+                assert_allclose(lyap.feed_dict[lyap.c_max], c_max)
+
+            pytest.raises(ValueError, lyap.update_safe_set, strategy='none')
+
+    def test_galloping_rounds(self, expanding_lyapunov):
+        """Test that galloping needs fewer rounds with several workers."""
+        lyap = expanding_lyapunov
+        rounds = []
+
+        def counting_map(function, batch_rounds, num_workers=1):
+            """Record the number of batches in each round."""
+            def record():
+                for batches in batch_rounds:
+                    rounds.append(len(batches))
+                    yield batches
+            return _map_rounds(function, record(), num_workers=num_workers)
+
+        def count_rounds(batch_size):
+            """Return the batches per round of both strategies."""
+            num_rounds = {}
+            with mock.patch.object(config, 'gp_batch_size', batch_size), \
+                    mock.patch('safe_learning.lyapunov._map_rounds',
+                               side_effect=counting_map):
+                for strategy in ('linear', 'galloping'):
+                    del rounds[:]
+                    lyap.update_safe_set(num_workers=2, strategy=strategy)
+                    num_rounds[strategy] = rounds[:]
+            return num_rounds
+
+        # The first unsafe state is the 28th in the order of values, in the
+        # tenth batch of three states. Linear waves of two batches reach it
+        # in the fifth round, galloping doubles the candidate from two
+        # batches and reaches it in the fourth round.
+        assert count_rounds(3) == {'linear': [2, 2, 2, 2, 2],
+                                   'galloping': [2, 2, 4, 6]}
+
+        # Both strategies verify the same batches if the first violation is
+        # part of the first round
+        assert count_rounds(20) == {'linear': [2], 'galloping': [2]}
+
+    def test_incremental_error(self, expanding_lyapunov):
+        """Test that incremental updates require a correlation method."""
+        pytest.raises(ValueError, expanding_lyapunov.update_safe_set,
+                      new_data=np.zeros((1, 2)))
+
+    def test_incremental_reuse(self, expanding_lyapunov):
+        """Test that cached decrease bounds are reused far from new data."""
+        lyap = expanding_lyapunov
+        states = lyap.discretization.all_points[:, 0]
+
+        def correlation(points, data):
+            """Squared exponential correlation in the state dimension."""
+            distance = points[:, :1] - tf.transpose(data[:, :1])
+            return tf.reduce_max(tf.exp(-distance ** 2 / (2 * 0.1 ** 2)),
+                                 axis=1)
+
+        lyap.dynamics.correlation = correlation
+        new_data = np.zeros((1, 2))
+
+        lyap.update_safe_set()
+        assert_equal(lyap.safe_set, np.abs(states) < 0.675)
+
+        # Wrong cache entries are only corrected close to the new data
+        lyap._decrease_margin[:] = 1.
+        lyap.update_safe_set(new_data=new_data)
+        assert_equal(lyap.safe_set, np.abs(states) < 0.375)
+
+        lyap._decrease_margin[:] = -1.
+        lyap.update_safe_set(new_data=new_data)
+        assert np.all(lyap.safe_set)
+
+        # Full update from scratch
+        lyap.update_safe_set()
+        assert_equal(lyap.safe_set, np.abs(states) < 0.675)
+
+    def test_incremental_early_stop(self, expanding_lyapunov):
+        """Test that states skipped by an early stop are verified again."""
+        lyap = expanding_lyapunov
+        states = lyap.discretization.all_points[:, 0]
+
+        def correlation(points, data):
+            """Squared exponential correlation in the state dimension."""
+            distance = points[:, :1] - tf.transpose(data[:, :1])
+            return tf.reduce_max(tf.exp(-distance ** 2 / (2 * 0.1 ** 2)),
+                                 axis=1)
+
+        lyap.dynamics.correlation = correlation
+        lyap.update_safe_set()
+
+        # Margins computed before the data close to the unsafe states
+        outer = np.abs(states) >= 0.675
+        lyap._decrease_margin[outer] = -1.
+        # A violation stops the scan before the outer states are reached
+        blocking = (np.abs(states) > 0.29) & (np.abs(states) < 0.41)
+        lyap._decrease_margin[blocking] = 1.
+
+        with mock.patch.object(config, 'gp_batch_size', 3):
+            lyap.update_safe_set(new_data=np.array([[0.9, 0.]]))
+            assert_equal(lyap.safe_set, np.abs(states) < 0.29)
+            assert np.all(np.isnan(lyap._decrease_margin[outer]))
+
+            # The second update is not correlated with the outer states,
+            # which still need to be verified against the earlier data
+            lyap._decrease_margin[blocking] = np.nan
+            lyap.update_safe_set(new_data=np.array([[5., 0.]]))
+            assert_equal(lyap.safe_set, np.abs(states) < 0.675)
+
+    @pytest.mark.skipif(gpflow is None, reason='gpflow module not installed')
+    def test_incremental_gaussian_process(self):
+        """Test that states close to new GP data are verified again."""
+        with tf.Session(graph=tf.Graph()):
+            discretization = GridWorld([[-1, 1]], 41)
+            states = discretization.all_points[:, 0]
+            lyap_fun = lambda x: tf.reduce_sum(tf.square(x),
+                                               axis=1,
+                                               keep_dims=True)
+            policy = lambda x: -0.1 * x
+
+            kernel = gpflow.kernels.RBF(2, lengthscales=0.1)
+            gp = GPRCached(np.array([[-0.8, 0.08]]), np.array([[-0.8]]),
+                           kernel)
+            # Small noise, so that the posterior covariance after adding the
+            # data is small everywhere
+            gp.likelihood.variance = 1e-4
+            gp.update_cache()
+            dynamics = GaussianProcess(gp)
+
+            lyap = Lyapunov(discretization, lyap_fun, dynamics, 1., 1., 0.,
+                            policy)
+            lyap.update_safe_set()
+
+            new_data = np.array([[0.5, -0.05]])
+            dynamics.add_data_point(new_data, np.array([[0.45]]))
+
+            # Wrong cache entries must be corrected close to the new data
+            lyap._decrease_margin[:] = -1.
+            lyap.update_safe_set(new_data=new_data)
+            margins = lyap._decrease_margin
+
+            near = np.abs(states - 0.5) < 0.075
+            far = np.abs(states) < 0.125
+            assert not np.any(margins[near] == -1.)
+            assert np.all(margins[far] == -1.)
+
 
 def test_smallest_boundary_value():
     """Test the boundary value function."""
@@ -82,6 +338,155 @@ def test_smallest_boundary_value():
         min_value = smallest_boundary_value(fun, discretization)
         assert min_value == 2.5
 
+        # The evaluation graph is reused
+        num_ops = len(tf.get_default_graph().get_operations())
+        with mock.patch.object(config, 'gp_batch_size', 3):
+            min_value = smallest_boundary_value(fun, discretization)
+        assert min_value == 2.5
+        assert len(tf.get_default_graph().get_operations()) == num_ops
+
+        # Lyapunov instances use their precomputed values
+        lyapunov = Lyapunov(discretization, fun, None, 1., 1., 0., None)
+        with mock.patch.object(lyapunov, 'lyapunov_function') as lyap_fun, \
+                mock.patch.object(lyapunov, 'update_values') as update:
+            assert smallest_boundary_value(lyapunov) == 2.5
+            assert not lyap_fun.called
+            assert not update.called
+
+    # The evaluation graph is specific to the default graph
+    with tf.Session(graph=tf.Graph()):
+        assert smallest_boundary_value(fun, discretization) == 2.5
+
+
+def test_get_lyapunov_region():
+    """Test the sweep method against the heap for the Lyapunov region."""
+    discretization = GridWorld([[-1, 1], [-1, 1]], [25, 21])
+    init_node = (12, 10)
+    states = discretization.all_points
+
+    random_state = np.random.RandomState(0)
+    noise = 1e-3 * random_state.rand(len(states))
+    # Quadratic function with a second local minimum at (0.6, 0)
+    bump = np.sum((states - [0.6, 0.]) ** 2, axis=1)
+    values = np.sum(states ** 2, axis=1) - 0.5 * np.exp(-bump / 0.02)
+    values += noise
+
+    with tf.Session():
+        fun = mock.Mock(side_effect=lambda x: tf.constant(values[:, None]),
+                        feed_dict={})
+
+        heap = get_lyapunov_region(fun, discretization, init_node)
+        sweep = get_lyapunov_region(fun, discretization, init_node,
+                                    method='sweep')
+        assert 0 < np.count_nonzero(heap) < len(states)
+        assert_equal(sweep, heap)
+
+        # Without noise, symmetric nodes share values
+        values -= noise
+        fun = mock.Mock(side_effect=lambda x: tf.constant(values[:, None]),
+                        feed_dict={})
+        heap = get_lyapunov_region(fun, discretization, init_node)
+        sweep = get_lyapunov_region(fun, discretization, init_node,
+                                    method='sweep')
+        assert 0 < np.count_nonzero(heap) < len(states)
+        assert_equal(sweep, heap)
+
+        # Symmetric quadratic function that reaches the boundary at a tie
+        values = np.sum(states ** 2, axis=1)
+        fun = mock.Mock(side_effect=lambda x: tf.constant(values[:, None]),
+                        feed_dict={})
+        heap = get_lyapunov_region(fun, discretization, init_node)
+        sweep = get_lyapunov_region(fun, discretization, init_node,
+                                    method='sweep')
+        assert_equal(heap, (values < 1.).reshape(heap.shape))
+        assert_equal(sweep, heap)
+
+        with pytest.raises(ValueError):
+            get_lyapunov_region(fun, discretization, init_node,
+                                method='unknown')
+
+    # The search stops when the values decrease and keeps the last node
+    discretization = GridWorld([[-1, 1]], 9)
+    values = np.array([9., 5., 3., 2., 0., 1., 4., 1.5, 8.])
+    expected = np.array([0, 0, 1, 1, 1, 1, 1, 1, 0], dtype=np.bool)
+
+    with tf.Session():
+        fun = mock.Mock(side_effect=lambda x: tf.constant(values[:, None]),
+                        feed_dict={})
+        for method in ('heap', 'sweep'):
+            region = get_lyapunov_region(fun, discretization, (4,),
+                                         method=method)
+            assert_equal(region, expected)
+
+
+def test_get_safe_sample():
+    """Test that batched safe sampling finds the most uncertain sample."""
+    with tf.Session(graph=tf.Graph()):
+        discretization = GridWorld([[-1, 1]], 21)
+        lyap_fun = lambda x: tf.reduce_sum(tf.square(x), axis=1,
+                                           keep_dims=True)
+        policy = lambda x: -0.5 * x
+
+        def dynamics(state_actions):
+            """Uncertain dynamics with larger errors for larger actions."""
+            states, actions = state_actions[:, :1], state_actions[:, 1:]
+            return (states + actions,
+                    0.1 * tf.abs(actions) + 0.01 * (states + 1) ** 2)
+
+        states = discretization.all_points
+        initial_set = np.where(np.abs(states[:, 0]) <= 0.5)[0]
+        lyap = Lyapunov(discretization, lyap_fun, dynamics, 1., 1., 0.,
+                        policy, initial_set=initial_set)
+        lyap.feed_dict[lyap.c_max] = 0.25
+
+        perturbations = np.linspace(-0.4, 0.4, 5)[:, None]
+        actions = np.linspace(-0.5, 0.5, 7)[:, None]
+
+        for kwargs in ({'perturbations': perturbations},
+                       {'actions': actions}):
+            # Brute force solution
+            safe_states = states[initial_set]
+            if 'actions' in kwargs:
+                candidates = actions.T + 0 * safe_states
+            else:
+                candidates = -0.5 * safe_states + perturbations.T
+            next_states = safe_states + candidates
+            var = 0.1 * np.abs(candidates) + 0.01 * (safe_states + 1) ** 2
+            next_index = discretization.state_to_index(
+                next_states.reshape(-1, 1))
+            safe = ((next_states ** 2 + var < 0.25).ravel()
+                    & lyap.safe_set[next_index])
+            max_id = np.argmax(np.where(safe, var.ravel(), -np.inf))
+            state_id, action_id = np.unravel_index(max_id, var.shape)
+            expected = [[safe_states[state_id, 0],
+                         candidates[state_id, action_id]]]
+
+            for batch_size in (4, 10000):
+                with mock.patch.object(config, 'gp_batch_size', batch_size):
+                    state_action, max_var = get_safe_sample(lyap, **kwargs)
+                assert_allclose(state_action, expected)
+                assert_allclose(max_var, var.ravel()[max_id])
+
+        # Multiple samples are the most uncertain ones for general dynamics
+        state_actions, max_vars = get_safe_sample(lyap, actions=actions,
+                                                  number=3)
+        assert state_actions.shape == (3, 2)
+        assert_allclose(max_vars, np.sort(var.ravel()[safe])[::-1][:3])
+
+
+def test_greedy_variance_selection():
+    """Test that the greedy selection avoids correlated points."""
+    # The first two points are perfectly correlated
+    covariance = np.array([[1., 1., 0.],
+                           [1., 1., 0.],
+                           [0., 0., 0.5]])
+    selected = _greedy_variance_selection([1.], [covariance], [0.], 2)
+    assert_equal(selected, [0, 2])
+
+    # With large noise, a single measurement hardly reduces the variance
+    selected = _greedy_variance_selection([1.], [covariance], [100.], 2)
+    assert_equal(selected, [0, 1])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -11,7 +11,7 @@ import scipy.linalg
 from safe_learning.utilities import dlqr
 
 from safe_learning import (PolicyIteration, Triangulation, GridWorld,
-                           QuadraticFunction, LinearSystem)
+                           QuadraticFunction, LinearSystem, config)
 
 if sys.version_info.major <= 2:
     import mock
@@ -79,6 +79,52 @@ class TestPolicyIteration(object):
         # assert(max_error < disc_error)
         # assert_allclose(rl.values, value_function.parameters[:, 0])
 
+    def test_discrete_policy_optimization(self):
+        """Test the batched policy optimization against a loop."""
+        with tf.Session(graph=tf.Graph()) as sess:
+            discretization = GridWorld([[-1, 1]], 11)
+            value_function = Triangulation(discretization,
+                                           -discretization.all_points ** 2,
+                                           project=True)
+            dynamics = LinearSystem((np.array([[1.2]]), np.array([[0.9]])))
+            reward_function = QuadraticFunction(np.diag([-1., -0.1]))
+
+            policy_discretization = GridWorld([-1, 1], 5)
+            policy = Triangulation(policy_discretization,
+                                   np.zeros((5, 1)))
+
+            rl = PolicyIteration(policy, dynamics, reward_function,
+                                 value_function)
+            sess.run(tf.global_variables_initializer())
+
+            action_space = np.linspace(-1, 1, 5)[:, None]
+            states = policy_discretization.all_points
+
+            # Brute force over all actions
+            values = np.column_stack([
+                rl.future_values(states, actions=0 * states + action).eval()
+                for action in action_space])
+            expected = action_space[np.argmax(values, axis=1)]
+
+            with mock.patch.object(config, 'gp_batch_size', 7):
+                rl.discrete_policy_optimization(action_space)
+            assert_allclose(policy.parameters[0].eval(), expected)
+
+            # Only allow negative actions
+            constraint = mock.Mock(side_effect=lambda x, u: -u[:, 0])
+
+            values[:, action_space[:, 0] > 0] = -np.inf
+            expected = action_space[np.argmax(values, axis=1)]
+            with mock.patch.object(config, 'gp_batch_size', 7):
+                rl.discrete_policy_optimization(action_space, constraint)
+            assert_allclose(policy.parameters[0].eval(), expected)
+
+            # The constraint is evaluated once per chunk of one state
+            assert constraint.call_count == len(states)
+            chunk_states, chunk_actions = constraint.call_args[0]
+            assert_allclose(chunk_states, np.repeat(states[-1:], 5, axis=0))
+            assert_allclose(chunk_actions, action_space)
+
     @pytest.mark.skipif(cvxpy is None, reason='Cvxpy is not installed.')
     def test_optimization(self):
         """Test the value function optimization."""
@@ -120,8 +166,14 @@ class TestPolicyIteration(object):
             sess.run(rl.optimize_value_function())
             values = rl.value_function.parameters[0].eval()
 
+            # The solver option is passed on to cvxpy
+            sess.run(tf.variables_initializer(value_function.parameters))
+            sess.run(rl.optimize_value_function(solver=cvxpy.ECOS))
+            ecos_values = rl.value_function.parameters[0].eval()
+
         # Confirm result
         assert_allclose(values, true_values)
+        assert_allclose(ecos_values, true_values)
 
         dynamics.assert_called_with(rl.state_space, 'actions')
         rewards.assert_called_with(rl.state_space, 'actions')
@@ -142,6 +194,146 @@ class TestPolicyIteration(object):
         #
         # assert_allclose(rl.values, true_values[:4])
 
+    def test_sparse_optimization(self):
+        """Test the sparse solvers for the value function optimization."""
+        dynamics = mock.Mock()
+        dynamics.return_value = np.arange(4, dtype=np.float)[:, None]
+
+        rewards = mock.Mock()
+        rewards.return_value = np.arange(4, dtype=np.float)[:, None]
+
+        trans_probs = np.array([[0, .5, .5, 0],
+                                [.2, .1, .3, .5],
+                                [.3, .2, .4, .1],
+                                [0, 0, 0, 1]],
+                               dtype=np.float)
+
+        value_function = mock.Mock()
+        value_function.tri.parameter_derivative.return_value = trans_probs
+        value_function.nindex = 4
+        value_function.parameters = [tf.Variable(np.zeros((4, 1),
+                                                          dtype=np.float))]
+        value_function.discretization.all_points = np.arange(
+            4, dtype=np.float)[:, None]
+
+        policy = mock.Mock()
+        policy.return_value = 'actions'
+
+        rl = PolicyIteration(policy, dynamics, rewards, value_function)
+
+        true_values = np.linalg.solve(np.eye(4) - rl.gamma * trans_probs,
+                                      rewards.return_value)
+
+        with tf.Session() as sess:
+            for method in ('spsolve', 'gmres', 'bicgstab'):
+                sess.run(tf.variables_initializer(value_function.parameters))
+                sess.run(rl.optimize_value_function(method=method))
+                values = rl.value_function.parameters[0].eval()
+                assert_allclose(values, true_values, rtol=1e-4)
+
+            with pytest.raises(ValueError):
+                rl.optimize_value_function(method='unknown')
+
+    def test_run_value_iteration(self):
+        """Test the repeated value iteration against a direct solve."""
+        with tf.Session(graph=tf.Graph()) as sess:
+            discretization = GridWorld([[-1, 1]], 19)
+            value_function = Triangulation(discretization,
+                                           0. * discretization.all_points,
+                                           project=True)
+            dynamics = LinearSystem((np.array([[1.2]]), np.array([[0.9]])))
+            policy = LinearSystem(-np.array([[1.]]))
+            reward_function = QuadraticFunction(np.diag([-1., -0.1]))
+
+            rl = PolicyIteration(policy, dynamics, reward_function,
+                                 value_function, gamma=0.9)
+            sess.run(tf.global_variables_initializer())
+
+            sess.run(rl.optimize_value_function(method='spsolve'))
+            true_values = value_function.parameters[0].eval()
+            sess.run(tf.global_variables_initializer())
+
+            num_iter, residuals = rl.run_value_iteration(max_iter=1000,
+                                                         tol=1e-8)
+            values = value_function.parameters[0].eval()
+
+            assert 1 < num_iter < 1000
+            assert len(residuals) == num_iter
+            assert residuals[-1] <= 1e-8 < residuals[-2]
+            assert_allclose(values, true_values, atol=1e-6)
+
+            # The graph is reused and the iteration stops after max_iter
+            num_ops = len(tf.get_default_graph().get_operations())
+            num_iter, residuals = rl.run_value_iteration(max_iter=2, tol=0.)
+            assert num_iter == len(residuals) == 2
+            assert len(tf.get_default_graph().get_operations()) == num_ops
+
+    def test_transition_operator(self):
+        """Test that the transition operator is cached per policy."""
+        with tf.Session(graph=tf.Graph()) as sess:
+            discretization = GridWorld([[-1, 1]], 11)
+            value_function = Triangulation(discretization,
+                                           0. * discretization.all_points,
+                                           project=True)
+            dynamics = LinearSystem((np.array([[1.2]]), np.array([[0.9]])))
+            reward_function = QuadraticFunction(np.diag([-1., -0.1]))
+
+            policy_discretization = GridWorld([-1, 1], 5)
+            policy = Triangulation(policy_discretization,
+                                   -0.5 * policy_discretization.all_points)
+
+            rl = PolicyIteration(policy, dynamics, reward_function,
+                                 value_function)
+            sess.run(tf.global_variables_initializer())
+
+            tri = value_function.tri
+            wrapped = mock.Mock(wraps=tri.parameter_derivative)
+            with mock.patch.object(tri, 'parameter_derivative', wrapped):
+                matrix, rewards = rl.transition_operator()
+                rl.run_value_iteration(max_iter=10)
+                assert wrapped.call_count == 1
+
+                # The states are only evaluated in batches
+                assert rl._state_space is None
+
+                # The operator matches the graph evaluation
+                values = np.random.RandomState(0).randn(11, 1)
+                sess.run(value_function.parameters[0].assign(values))
+                assert_allclose(rewards + rl.gamma * matrix.dot(values[:, 0]),
+                                rl.future_values(rl.state_space).eval()[:, 0])
+
+                # Changing the policy invalidates the cached operator
+                policy_parameters = policy.parameters[0]
+                sess.run(policy_parameters.assign(0. * policy_parameters))
+                new_matrix, new_rewards = rl.transition_operator()
+                assert wrapped.call_count == 2
+                assert_allclose(new_rewards,
+                                -discretization.all_points[:, 0] ** 2)
+
+                rl.clear_transition_operator()
+                rl.transition_operator()
+                assert wrapped.call_count == 3
+
+                # The states are evaluated in batches
+                rl.clear_transition_operator()
+                with mock.patch.object(config, 'gp_batch_size', 4):
+                    batch_matrix, batch_rewards = rl.transition_operator()
+                assert wrapped.call_count == 6
+                assert_allclose(batch_matrix.toarray(),
+                                new_matrix.toarray())
+                assert_allclose(batch_rewards, new_rewards)
+
+                # A policy without parameters is fixed
+                rl = PolicyIteration(lambda x: -0.5 * x, dynamics,
+                                     reward_function, value_function)
+                rl.transition_operator()
+                rl.transition_operator()
+                assert wrapped.call_count == 7
+
+                rl.clear_transition_operator()
+                rl.transition_operator()
+                assert wrapped.call_count == 8
+
     def test_future_values(self):
         """Test future values."""
         dynamics = mock.Mock()
@@ -2,6 +2,8 @@
 
 from __future__ import absolute_import, print_function, division
 
+import sys
+
 import pytest
 import numpy as np
 import tensorflow as tf
@@ -9,9 +11,15 @@ from numpy.testing import assert_allclose
 
 from safe_learning.utilities import (dlqr, get_storage, set_storage,
                                      get_feed_dict, unique_rows,
-                                     compute_trajectory)
+                                     compute_trajectory, compute_trajectories,
+                                     parameter_token)
+
+from safe_learning import LinearSystem, config
 
-from safe_learning import LinearSystem
+if sys.version_info.major <= 2:
+    import mock
+else:
+    from unittest import mock
 
 
 def test_dlqr():
@@ -83,6 +91,29 @@ def test_get_feed_dict():
     assert feed_dict is get_feed_dict(graph)
 
 
+def test_parameter_token():
+    """Test that the token only depends on the parameter values."""
+    # Objects other than arrays and variables are not parameters
+    assert parameter_token(None) is None
+    assert parameter_token([]) is None
+    assert parameter_token(mock.MagicMock()) is None
+
+    array = np.array([1., 2.])
+    token = parameter_token([array, mock.MagicMock()])
+    assert token == parameter_token(array)
+    array[0] = 3.
+    assert parameter_token(array) != token
+
+    with tf.Session(graph=tf.Graph()) as sess:
+        variable = tf.Variable(1., dtype=config.dtype)
+        sess.run(tf.global_variables_initializer())
+
+        token = parameter_token([variable])
+        assert parameter_token([variable]) == token
+        sess.run(variable.assign(2.))
+        assert parameter_token([variable]) != token
+
+
 def test_unique_rows():
     """Test the unique_rows function."""
     a = np.array([[1, 1], [1, 2], [1, 3], [1, 2], [1, 3], [1, 4], [2, 3]])
@@ -111,4 +142,64 @@ def test_compute_trajectory():
     states, actions = res
     assert_allclose(states[[0], :], x0)
     assert_allclose(states[-1, :], np.array([0., 0.]), atol=0.01)
-    assert_allclose(actions, states[:-1].dot(-K.T))
\ No newline at end of file
+    assert_allclose(actions, states[:-1].dot(-K.T))
+
+
+def test_compute_trajectories():
+    """Test the batched rollout against single trajectories."""
+    A = np.array([[1., 0.1],
+                  [0., 1.]])
+    B = np.array([[0.01],
+                  [0.1]])
+
+    dynamics = LinearSystem((A, B))
+    K, _ = dlqr(A, B, np.diag([1., 0.01]), np.array([[0.01]]))
+    policy = LinearSystem([-K])
+
+    x0 = np.array([[0.1, 0.],
+                   [-0.2, 0.1],
+                   [0., 0.3]])
+    with tf.Session():
+        with mock.patch.object(config, 'gp_batch_size', 2):
+            states, actions = compute_trajectories(dynamics, policy, x0,
+                                                   num_steps=20)
+        assert states.shape == (3, 20, 2)
+        assert actions.shape == (3, 19, 1)
+
+        for state, action, initial_state in zip(states, actions, x0):
+            true_states, true_actions = compute_trajectory(
+                dynamics, policy, initial_state, num_steps=20)
+            assert_allclose(state, true_states)
+            assert_allclose(action, true_actions)
+
+        # Trajectories stop once they are close to the origin
+        def terminate(states):
+            return tf.reduce_sum(tf.abs(states), axis=1) < 0.15
+
+        term_states, term_actions = compute_trajectories(
+            dynamics, policy, x0, num_steps=20, terminate=terminate)
+
+        # All initial states satisfy the termination condition
+        def terminate_all(states):
+            return tf.reduce_sum(tf.abs(states), axis=1) < 1.
+
+        static_states, static_actions = compute_trajectories(
+            dynamics, policy, x0, num_steps=20, terminate=terminate_all)
+        assert_allclose(static_states, np.tile(x0[:, None, :], (1, 20, 1)))
+        assert static_actions.shape == (3, 19, 1)
+        assert np.all(np.isnan(static_actions))
+
+        # Trajectories without any steps
+        single_states, single_actions = compute_trajectories(
+            dynamics, policy, x0, num_steps=1)
+        assert_allclose(single_states, x0[:, None, :])
+        assert single_actions.shape == (3, 0, 1)
+
+    norms = np.sum(np.abs(states), axis=2)
+    for i, norm in enumerate(norms):
+        end = np.argmax(norm < 0.15)
+        assert_allclose(term_states[i, :end + 1], states[i, :end + 1])
+        assert_allclose(term_states[i, end:], states[i, [end]] + 0 *
+                        states[i, end:])
+        assert_allclose(term_actions[i, :end], actions[i, :end])
+        assert np.all(np.isnan(term_actions[i, end:]))
@@ -11,8 +11,10 @@ Author: Felix Berkenkamp, Learning & Adaptive Systems Group, ETH Zurich
 
 from __future__ import absolute_import, division, print_function
 
+import hashlib
 import itertools
 import inspect
+from collections import Sequence
 from functools import wraps, partial
 
 import numpy as np
@@ -28,7 +30,7 @@ __all__ = ['combinations', 'linearly_spaced_combinations', 'lqr', 'dlqr',
            'ellipse_bounds', 'concatenate_inputs', 'make_tf_fun',
            'with_scope', 'use_parent_scope', 'add_weight_constraint',
            'batchify', 'get_storage', 'set_storage', 'unique_rows',
-           'gradient_clipping']
+           'gradient_clipping', 'parameter_token']
 
 
 _STORAGE = {}
@@ -408,6 +410,15 @@ def ellipse_bounds(P, level, n=100):
     return pos[:n, 0], pos[:n, 1], pos[:n - 1:-1, 1]
 
 
+def _caller_name():
+    """Return the name of the function that called the calling function.
+
+    This only reads the code object of the frame. In contrast to
+    `inspect.getframeinfo`, it does not load any source code.
+    """
+    return inspect.currentframe().f_back.f_back.f_code.co_name
+
+
 def get_storage(dictionary, index=None):
     """Get a unique storage point within a class method.
 
@@ -427,8 +438,7 @@ def get_storage(dictionary, index=None):
         returns the OrderedDict that was previously put in the storage.
     """
     # Use function name as storage name
-    frame = inspect.currentframe()
-    storage_name = inspect.getframeinfo(frame.f_back).function
+    storage_name = _caller_name()
 
     storage = dictionary.get(storage_name)
 
@@ -458,8 +468,7 @@ def set_storage(dictionary, name_value, index=None):
         different arguements.
     """
     # Use function name as storage name
-    frame = inspect.currentframe()
-    storage_name = inspect.getframeinfo(frame.f_back).function
+    storage_name = _caller_name()
 
     storage = OrderedDict(name_value)
     if index is None:
@@ -493,6 +502,44 @@ def get_feed_dict(graph):
         return graph.feed_dict_sl
 
 
+def parameter_token(parameters, feed_dict=None):
+    """Return a token that identifies the current values of parameters.
+
+    Parameters
+    ----------
+    parameters : list
+        A list of numpy arrays or tensorflow variables. Other objects are
+        ignored.
+    feed_dict : dict, optional
+        The feed_dict used to evaluate the tensorflow variables.
+
+    Returns
+    -------
+    token : str
+        A hash of the parameter values. None if there are no parameters.
+    """
+    if not isinstance(parameters, Sequence):
+        parameters = [parameters]
+
+    parameters = [param for param in parameters
+                  if isinstance(param, (np.ndarray, tf.Variable))]
+    if not parameters:
+        return None
+
+    # Only tensorflow variables need to be fetched from the session
+    tensors = [param for param in parameters
+               if isinstance(param, tf.Variable)]
+    if tensors:
+        session = tf.get_default_session()
+        values = iter(session.run(tensors, feed_dict=feed_dict))
+
+    token = hashlib.sha1()
+    for param in parameters:
+        value = param if isinstance(param, np.ndarray) else next(values)
+        token.update(np.ascontiguousarray(value).view(np.uint8))
+    return token.hexdigest()
+
+
 def unique_rows(array):
     """Return the unique rows of the array.
 
@@ -581,3 +628,140 @@ def compute_trajectory(dynamics, policy, initial_state, num_steps):
                                                       feed_dict=feed_dict)
 
     return states, actions
+
+
+def compute_trajectories(dynamics, policy, initial_states, num_steps,
+                         terminate=None):
+    """Compute state trajectories for many initial states at once.
+
+    All trajectories are simulated together inside a single `tf.while_loop`,
+    in batches of `config.gp_batch_size` initial states.
+
+    Parameters
+    ----------
+    dynamics : callable
+        A function that takes the current states and actions as input and
+        returns the next states.
+    policy : callable
+        A function that takes the current states as input and returns the
+        actions.
+    initial_states : ndarray
+        A (n_trajectories x state_dim) array of initial states.
+    num_steps : int
+        The number of steps for which to simulate the system.
+    terminate : callable, optional
+        A function that takes states as input and returns a boolean for each
+        state. Once it is True, a trajectory keeps its current state and all
+        following actions are NaN. The simulation stops early when all
+        trajectories are terminated.
+
+    Returns
+    -------
+    states : ndarray
+        A (n_trajectories x num_steps x state_dim) array of states.
+    actions : ndarray
+        A (n_trajectories x num_steps - 1 x action_dim) array with the
+        corresponding actions.
+    """
+    initial_states = np.atleast_2d(initial_states)
+    n_trajectories, state_dim = initial_states.shape
+    action_dim = policy.output_dim
+
+    dtype = config.np_dtype
+    if num_steps == 1:
+        states = initial_states[:, None, :].astype(dtype)
+        return states, np.empty((n_trajectories, 0, action_dim), dtype=dtype)
+
+    # Get storage (indexed by dynamics, policy, and termination condition)
+    index = (dynamics, policy, terminate)
+    storage = get_storage(_STORAGE, index=index)
+
+    if storage is None:
+        tf_states = tf.placeholder(config.dtype, [None, state_dim],
+                                   name='initial_states')
+        tf_num_steps = tf.placeholder(tf.int32, [], name='num_steps')
+
+        # Create the variables of the functions outside of the loop
+        dynamics(tf_states, policy(tf_states))
+
+        def condition(i, states, active, state_array, action_array):
+            return tf.logical_and(i < tf_num_steps - 1,
+                                  tf.reduce_any(active))
+
+        def body(i, states, active, state_array, action_array):
+            actions = policy(states)
+            next_states = tf.reshape(dynamics(states, actions),
+                                     [-1, state_dim])
+
+            if terminate is not None:
+                next_states = tf.where(active, next_states, states)
+                actions = tf.where(active, actions,
+                                   np.nan * tf.ones_like(actions))
+                done = tf.reshape(terminate(next_states), [-1])
+                active = tf.logical_and(active, tf.logical_not(done))
+
+            state_array = state_array.write(i + 1, next_states)
+            action_array = action_array.write(i, actions)
+            return i + 1, next_states, active, state_array, action_array
+
+        state_array = tf.TensorArray(config.dtype, size=tf_num_steps,
+                                     element_shape=[None, state_dim])
+        action_array = tf.TensorArray(config.dtype, size=tf_num_steps - 1,
+                                      element_shape=[None, action_dim])
+        if terminate is None:
+            active = tf.ones_like(tf_states[:, 0], dtype=tf.bool)
+        else:
+            active = tf.logical_not(tf.reshape(terminate(tf_states), [-1]))
+
+        loop_vars = [tf.constant(0), tf_states, active,
+                     state_array.write(0, tf_states), action_array]
+        steps, _, _, state_array, action_array = tf.while_loop(
+            condition, body, loop_vars)
+
+        # Only the first steps are written if the loop terminates early
+        tf_trajectory = tf.transpose(state_array.gather(tf.range(steps + 1)),
+                                     [1, 0, 2])
+
+        # Gathering zero elements fails for an unknown batch size
+        def gather_actions():
+            return tf.transpose(action_array.gather(tf.range(steps)),
+                                [1, 0, 2])
+
+        def no_actions():
+            shape = tf.stack((tf.shape(tf_states)[0], 0, action_dim))
+            return tf.zeros(shape, dtype=config.dtype)
+
+        tf_actions = tf.cond(steps > 0, gather_actions, no_actions)
+
+        storage = [('tf_states', tf_states),
+                   ('tf_num_steps', tf_num_steps),
+                   ('tf_trajectory', tf_trajectory),
+                   ('tf_actions', tf_actions)]
+
+        set_storage(_STORAGE, storage, index=index)
+    else:
+        tf_states, tf_num_steps, tf_trajectory, tf_actions = storage.values()
+
+    states = np.empty((n_trajectories, num_steps, state_dim), dtype=dtype)
+    actions = np.empty((n_trajectories, num_steps - 1, action_dim),
+                       dtype=dtype)
+
+    session = tf.get_default_session()
+    feed_dict = get_feed_dict(session.graph).copy()
+    feed_dict[tf_num_steps] = num_steps
+
+    for i, (batch,) in batchify(initial_states, config.gp_batch_size):
+        feed_dict[tf_states] = batch
+        trajectory, batch_actions = session.run([tf_trajectory, tf_actions],
+                                                feed_dict=feed_dict)
+        steps = trajectory.shape[1]
+        i_next = i + len(batch)
+
+        states[i:i_next, :steps] = trajectory
+        actions[i:i_next, :steps - 1] = batch_actions
+
+        # All trajectories in the batch terminated early
+        states[i:i_next, steps:] = trajectory[:, -1:]
+        actions[i:i_next, steps - 1:] = np.nan
+
+    return states, actions
@@ -0,0 +1,249 @@
+"""Benchmarks for the computationally expensive parts of safe_learning.
+
+Run all benchmarks with `python scripts/benchmark.py` or select individual
+ones by name, e.g. `python scripts/benchmark.py safe_set`.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import inspect
+import sys
+import timeit
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+
+import safe_learning
+from safe_learning import config
+from safe_learning.utilities import dlqr, get_storage, set_storage
+
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(function):
+    """Register a benchmark function under its name."""
+    BENCHMARKS[function.__name__.replace('benchmark_', '', 1)] = function
+    return function
+
+
+def best_time(function, repeat=3):
+    """Return the best wall-clock time of several calls to a function."""
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def print_table(header, rows):
+    """Print the results of a benchmark as a simple table."""
+    print(('{:>14}' * len(header)).format(*header))
+    for row in rows:
+        print(''.join('{:>14.4g}'.format(value) for value in row))
+    print()
+
+
+def linear_lyapunov(num_points):
+    """Return a `Lyapunov` instance for a stable 2D linear system.
+
+    Needs to be called within a default session.
+    """
+    a = np.array([[1., 0.01],
+                  [0., 1.]])
+    b = np.array([[0.0001],
+                  [0.01]])
+    q = np.diag([1., 0.1])
+    r = np.array([[0.1]])
+    k, p = dlqr(a, b, q, r)
+
+    discretization = safe_learning.GridWorld([[-1, 1], [-1, 1]], num_points)
+    dynamics = safe_learning.LinearSystem((a, b))
+    policy = safe_learning.LinearSystem(-k)
+    lyapunov_function = safe_learning.QuadraticFunction(p)
+
+    epsilon = np.max(discretization.unit_maxes)
+    initial_set = discretization.state_to_index(np.zeros((1, 2)))
+    return safe_learning.Lyapunov(discretization, lyapunov_function, dynamics,
+                                  lipschitz_dynamics=1.,
+                                  lipschitz_lyapunov=1e-3,
+                                  epsilon=epsilon,
+                                  policy=policy,
+                                  initial_set=initial_set)
+
+
+@benchmark
+def benchmark_safe_set(num_points=1000, workers=(1, 2, 4, 8)):
+    """Verify the safe set with an increasing number of workers."""
+    print('Lyapunov.update_safe_set on a {0}x{0} grid, batch size {1}'
+          .format(num_points, config.gp_batch_size))
+
+    times = []
+    with tf.Session(graph=tf.Graph()):
+        lyapunov = linear_lyapunov(num_points)
+        lyapunov.update_safe_set()
+
+        for num_workers in workers:
+            times.append(best_time(
+                lambda: lyapunov.update_safe_set(num_workers=num_workers)))
+
+    rows = [(num_workers, elapsed, times[0] / elapsed)
+            for num_workers, elapsed in zip(workers, times)]
+    print_table(('workers', 'time [s]', 'speedup'), rows)
+
+
+@benchmark
+def benchmark_lyapunov_region(sizes=(101, 201, 401, 801)):
+    """Compare the heap and sweep methods of `get_lyapunov_region`."""
+    print('get_lyapunov_region on n x n grids')
+
+    rows = []
+    for num_points in sizes:
+        with tf.Session(graph=tf.Graph()):
+            lyapunov = linear_lyapunov(num_points)
+            init_node = (num_points // 2,) * 2
+
+            times = [best_time(lambda: safe_learning.get_lyapunov_region(
+                lyapunov.lyapunov_function, lyapunov.discretization,
+                init_node, method=method), repeat=1)
+                for method in ('heap', 'sweep')]
+
+        rows.append((num_points, times[0], times[1], times[0] / times[1]))
+
+    print_table(('n', 'heap [s]', 'sweep [s]', 'speedup'), rows)
+
+
+@benchmark
+def benchmark_triangulation(dimensions=(2, 3, 4, 5, 6), num_samples=100000):
+    """Compare the scipy Delaunay and the Kuhn triangulation."""
+    print('_Triangulation with {} random points, 5 points per dimension'
+          .format(num_samples))
+
+    rows = []
+    for ndim in dimensions:
+        discretization = safe_learning.GridWorld([[-1, 1]] * ndim, 5)
+        points = discretization.sample_continuous(num_samples)
+
+        row = [ndim]
+        with tf.Graph().as_default():
+            for method in ('delaunay', 'kuhn'):
+                row.append(best_time(lambda: safe_learning._Triangulation(
+                    discretization, method=method), repeat=1))
+                tri = safe_learning._Triangulation(discretization,
+                                                   method=method)
+                row.append(best_time(lambda: tri._get_weights(points)))
+        rows.append(row)
+
+    print_table(('ndim', 'delaunay init', 'delaunay [s]', 'kuhn init',
+                 'kuhn [s]'), rows)
+
+
+@benchmark
+def benchmark_gp_update(sizes=(250, 500, 1000, 2000), num_updates=10):
+    """Add data points to GPRCached with full and incremental updates."""
+    import gpflow
+
+    print('GPRCached.update_cache per added data point')
+
+    rows = []
+    for num_data in sizes:
+        x = np.random.uniform(-1, 1, size=(num_data + num_updates, 2))
+        y = np.sin(3 * x[:, :1])
+
+        row = [num_data]
+        for interval in (1, num_updates + 1):
+            with tf.Graph().as_default():
+                gp = safe_learning.GPRCached(x[:num_data], y[:num_data],
+                                             gpflow.kernels.RBF(2),
+                                             refactorization_interval=interval)
+
+                def add_data_points():
+                    for i in range(num_data, num_data + num_updates):
+                        gp.X = x[:i + 1]
+                        gp.Y = y[:i + 1]
+                        gp.update_cache()
+
+                row.append(best_time(add_data_points, repeat=1) / num_updates)
+        rows.append(row + [row[1] / row[2]])
+
+    print_table(('n', 'full [s]', 'incr. [s]', 'speedup'), rows)
+
+
+@benchmark
+def benchmark_value_optimization(sizes=(11, 21, 41, 81),
+                                 methods=('cvxpy', 'spsolve', 'gmres',
+                                          'bicgstab')):
+    """Compare the methods of `PolicyIteration.optimize_value_function`."""
+    try:
+        import cvxpy  # noqa: F401
+    except ImportError:
+        methods = tuple(method for method in methods if method != 'cvxpy')
+
+    print('PolicyIteration.optimize_value_function on n x n grids')
+
+    a = np.array([[1., 0.01],
+                  [0., 1.]])
+    b = np.array([[0.0001],
+                  [0.01]])
+    q = np.diag([1., 0.1])
+    r = np.array([[0.1]])
+    k, _ = dlqr(a, b, q, r)
+
+    rows = []
+    for num_points in sizes:
+        with tf.Session(graph=tf.Graph()) as sess:
+            discretization = safe_learning.GridWorld([[-1, 1], [-1, 1]],
+                                                     num_points)
+            value_function = safe_learning.Triangulation(
+                discretization, np.zeros((discretization.nindex, 1)),
+                project=True)
+            rl = safe_learning.PolicyIteration(
+                safe_learning.LinearSystem(-k),
+                safe_learning.LinearSystem((a, b)),
+                safe_learning.QuadraticFunction(
+                    -np.diag([1., 0.1, 0.1])),
+                value_function)
+            sess.run(tf.global_variables_initializer())
+
+            row = [num_points]
+            for method in methods:
+                update = rl.optimize_value_function(method=method)
+                row.append(best_time(lambda: sess.run(update), repeat=1))
+        rows.append(row)
+
+    print_table(('n',) + tuple('{} [s]'.format(method)
+                               for method in methods), rows)
+
+
+@benchmark
+def benchmark_storage(number=10000):
+    """Per-call overhead of the graph storage lookup."""
+    print('Storage lookup and update per call in microseconds')
+
+    def frame_info_name():
+        """Look up the name of the caller with the source line."""
+        frame = inspect.currentframe()
+        return inspect.getframeinfo(frame.f_back).function
+
+    def frame_info_lookup(dictionary):
+        storage = dictionary.get(frame_info_name())
+        dictionary[frame_info_name()] = OrderedDict([('value', 0)])
+        return storage
+
+    def storage_lookup(dictionary):
+        storage = get_storage(dictionary)
+        set_storage(dictionary, [('value', 0)])
+        return storage
+
+    times = []
+    for lookup in (frame_info_lookup, storage_lookup):
+        dictionary = {}
+        elapsed = min(timeit.repeat(lambda: lookup(dictionary),
+                                    number=number, repeat=3))
+        times.append(1e6 * elapsed / number)
+
+    print_table(('getframeinfo', 'get_storage', 'speedup'),
+                [(times[0], times[1], times[0] / times[1])])
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()